@@ -21,6 +21,7 @@ if __name__ == '__main__':
     parser.add_argument('--config_name',  type=str,     default='simtpr')
     parser.add_argument('--games',        type=str,     default='[]') 
     parser.add_argument('--seeds',        type=str,     default='[1,2,3,4,5]')
+    parser.add_argument('--num_seeds_per_process', type=int, default=1) # >1: seeds are vectorized in one process
     parser.add_argument('--num_devices',  type=int,     default=6)
     parser.add_argument('--num_exp_per_device',  type=int,  default=3)
     parser.add_argument('--overrides',    type=str,     default=[],      nargs='*') 
@@ -35,19 +36,28 @@ if __name__ == '__main__':
     if len(games) == 0:
         games = all_games
 
+    num_seeds_per_process = args.pop('num_seeds_per_process')
+    seed_groups = [seeds[idx:idx + num_seeds_per_process] 
+                   for idx in range(0, len(seeds), num_seeds_per_process)]
+    # a process runs the seeds seed, seed+1, ... (cfg.seed + k for its k-th seed)
+    for seed_group in seed_groups:
+        if seed_group != list(range(seed_group[0], seed_group[0] + len(seed_group))):
+            raise ValueError('seeds vectorized in one process must be consecutive, got ' + str(seed_group))
+
     num_devices = args.pop('num_devices')
     num_exp_per_device = args.pop('num_exp_per_device')
     pool_size = num_devices * num_exp_per_device 
 
     # create configurations for child run
     experiments = []
-    for seed, game in itertools.product(*[seeds, games]):
+    for seed_group, game in itertools.product(*[seed_groups, games]):
         exp = copy.deepcopy(args)
         group_name = exp.pop('group_name')
         exp_name = exp.pop('exp_name')
         exp['overrides'].append('group_name=' + group_name)
         exp['overrides'].append('exp_name=' + exp_name)
-        exp['overrides'].append('seed=' + str(seed))
+        exp['overrides'].append('seed=' + str(seed_group[0]))
+        exp['overrides'].append('num_seeds=' + str(len(seed_group)))
         exp['overrides'].append('env.game=' + str(game))
 
         experiments.append(exp)
@@ -0,0 +1,231 @@
+import argparse
+import itertools
+import threading
+import time
+import gc
+import psutil
+from hydra import compose, initialize
+from src.dataloaders import build_loader_cfgs
+from src.envs import *
+from src.models import *
+from src.trainers import build_trainer
+from dotmap import DotMap
+import torch
+
+
+class PeakMemoryMonitor():
+    def __init__(self, interval=0.05):
+        """
+        Tracks the peak resident memory (in GB) of this process and its DataLoader workers.
+        """
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = 0.0
+        self._stop = threading.Event()
+
+    def _rss(self):
+        rss = self.process.memory_info().rss
+        for child in self.process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return rss / 1024 ** 3
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+def run_trial(cfg, train_loader, env, device, num_warmup_steps, num_steps):
+    model = build_model(cfg.model)
+    trainer = build_trainer(cfg=cfg.trainer,
+                            train_loader=train_loader,
+                            eval_act_loader=None,
+                            eval_rew_loader=None,
+                            env=env,
+                            device=device,
+                            logger=None,
+                            agent_logger=None,
+                            model=model)
+
+    # real SimTPR update steps, timed after the warmup
+    num_samples = 0
+    batches = iter(train_loader)
+    for step in range(num_warmup_steps + num_steps):
+        if step == num_warmup_steps:
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+        try:
+            batch = next(batches)
+        except StopIteration:
+            batches = iter(train_loader)
+            batch = next(batches)
+        trainer.train_step(batch)
+        if step >= num_warmup_steps:
+            num_samples += len(batch.action)
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.time() - start
+
+    return num_samples / elapsed
+
+
+def run(args):
+    args = DotMap(args)
+    config_dir = args.config_dir
+    config_name = args.config_name
+    overrides = args.overrides
+
+    # Hydra Compose
+    config_path = './configs/' + config_dir
+    initialize(version_base=None, config_path=config_path)
+    cfg = compose(config_name=config_name, overrides=overrides)
+
+    # device
+    device = torch.device(cfg.device)
+    cfg.dataloader.device = cfg.device
+
+    # shape config
+    cfg.env.game = cfg.dataloader.game
+    env, _ = build_env(cfg.env)
+    obs_shape = [cfg.dataloader.train.frame] + list(env.observation_space.shape[1:])
+    action_size = env.action_space.n
+    param_dict = {'obs_shape': obs_shape,
+                  'action_size': action_size,
+                  't_step': cfg.dataloader.train.t_step}
+
+    for key, value in param_dict.items():
+        if key in cfg.model.backbone:
+            cfg.model.backbone[key] = value
+
+        if key in cfg.model.head:
+            cfg.model.head[key] = value
+
+        if key in cfg.model.policy:
+            cfg.model.policy[key] = value
+
+        if key in cfg.trainer:
+            cfg.trainer[key] = value
+
+    # search space
+    # placement: 'device' keeps the dataset as a tensor on cfg.device, 'disk' memmaps it
+    placements = eval(args.placements)
+    batch_sizes = eval(args.batch_sizes)
+    if len(batch_sizes) == 0:
+        batch_sizes = [cfg.dataloader.train.batch_size]
+    grid = list(itertools.product(eval(args.num_threads),
+                                  eval(args.num_workers),
+                                  eval(args.prefetch_factors),
+                                  eval(args.pin_memory),
+                                  batch_sizes))
+
+    results = []
+    loader, train_cfg, _, _ = build_loader_cfgs(cfg.dataloader)
+    for placement in placements:
+        train_cfg['dataset_on_gpu'] = (placement == 'device')
+        train_cfg['dataset_on_disk'] = (placement == 'disk')
+        dataset = loader(**train_cfg).get_dataset()
+
+        for num_threads, num_workers, prefetch_factor, pin_memory, batch_size in grid:
+            # workers can not access tensors on cuda, pinning only helps host-to-cuda copies
+            if placement == 'device' and device.type == 'cuda' and num_workers > 0:
+                continue
+            if pin_memory and (device.type != 'cuda' or placement == 'device'):
+                continue
+            if num_workers == 0 and prefetch_factor != eval(args.prefetch_factors)[0]:
+                continue
+
+            trial = {'num_threads': num_threads,
+                     'num_workers': num_workers,
+                     'prefetch_factor': prefetch_factor,
+                     'pin_memory': pin_memory,
+                     'batch_size': batch_size,
+                     'placement': placement}
+            trial_cfg = dict(train_cfg)
+            trial_cfg.update({k: v for k, v in trial.items() if k not in ['num_threads', 'placement']})
+            cfg.trainer.batch_size = batch_size
+            torch.set_num_threads(num_threads)
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+
+            with PeakMemoryMonitor() as monitor:
+                train_loader = loader(**trial_cfg).get_dataloader(dataset=dataset)
+                samples_per_sec = run_trial(cfg, train_loader, env, device,
+                                            args.num_warmup_steps, args.num_steps)
+                del train_loader
+                gc.collect()
+
+            trial['samples_per_sec'] = samples_per_sec
+            trial['peak_memory_gb'] = monitor.peak
+            # with placement 'device' the dataset lives in cuda memory, which the host rss does not see
+            if device.type == 'cuda':
+                trial['peak_device_memory_gb'] = torch.cuda.max_memory_allocated(device) / 1024 ** 3
+            results.append(trial)
+            print(trial)
+
+        del dataset
+        gc.collect()
+
+    # best throughput within the host and device memory caps
+    device_memory_cap_gb = args.device_memory_cap_gb
+    if device_memory_cap_gb is None and device.type == 'cuda':
+        device_memory_cap_gb = torch.cuda.get_device_properties(device).total_memory / 1024 ** 3
+    valid_results = [r for r in results
+                     if r['peak_memory_gb'] <= args.memory_cap_gb
+                     and r.get('peak_device_memory_gb', 0.0) <= (device_memory_cap_gb or 0.0)]
+    if len(valid_results) == 0:
+        raise ValueError('no configuration fits in memory_cap_gb / device_memory_cap_gb')
+    best = max(valid_results, key=lambda r: r['samples_per_sec'])
+    print(f'best configuration: {best}')
+
+    # hydra overrides for run_pretrain.py --overrides_file
+    best_overrides = ['num_threads=' + str(best['num_threads']),
+                      'dataloader.num_workers=' + str(best['num_workers']),
+                      'dataloader.prefetch_factor=' + str(best['prefetch_factor']),
+                      'dataloader.pin_memory=' + str(best['pin_memory']),
+                      'dataloader.dataset_on_gpu=' + str(best['placement'] == 'device'),
+                      'dataloader.dataset_on_disk=' + str(best['placement'] == 'disk'),
+                      'dataloader.train.batch_size=' + str(best['batch_size'])]
+    peak = f"{best['peak_memory_gb']:.2f} GB peak"
+    if 'peak_device_memory_gb' in best:
+        peak += f", {best['peak_device_memory_gb']:.2f} GB device peak"
+    with open(args.output, 'w') as f:
+        f.write(f"# generated by run_autotune.py: {best['samples_per_sec']:.1f} samples/s, {peak}\n")
+        for override in best_overrides:
+            f.write(override + '\n')
+    print(f'wrote overrides to {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument('--config_dir',       type=str,    default='atari/pretrain')
+    parser.add_argument('--config_name',      type=str,    default='simtpr')
+    parser.add_argument('--placements',       type=str,    default="['device', 'disk']")
+    parser.add_argument('--batch_sizes',      type=str,    default='[]') # [] keeps the configured batch size
+    parser.add_argument('--num_threads',      type=str,    default='[1, 4]')
+    parser.add_argument('--num_workers',      type=str,    default='[0, 2, 4, 8]')
+    parser.add_argument('--prefetch_factors', type=str,    default='[2, 4]')
+    parser.add_argument('--pin_memory',       type=str,    default='[False, True]')
+    parser.add_argument('--num_warmup_steps', type=int,    default=5)
+    parser.add_argument('--num_steps',        type=int,    default=30)
+    parser.add_argument('--memory_cap_gb',    type=float,  default=64.0) # host rss of the process and its workers
+    parser.add_argument('--device_memory_cap_gb', type=float, default=None) # cuda peak, None: total memory of the device
+    parser.add_argument('--output',           type=str,    default='autotune_overrides.txt')
+    parser.add_argument('--overrides',        action='append', default=[])
+    args = parser.parse_args()
+
+    run(vars(args))
@@ -0,0 +1,404 @@
+import argparse
+import time
+import torch
+import torch.nn.functional as F
+from dotmap import DotMap
+from src.common.augmentation import RandomShiftsAug
+from src.models.backbones import Impala
+from src.models.heads import SimTPRHead
+from src.models.policies import RainbowPolicy
+from src.models.policies.rainbow_policy import NoisyLinear
+from src.common.losses import ConsistencyLoss, BarlowLoss
+from src.common.train_utils import autocast
+from src.models.base import Model
+from src.models.inference import quantize_actor, export_inference_model
+from src.models.layers import interleave
+
+
+def measure(fn, device, num_warmup=5, num_iters=50):
+    """
+    [returns] mean latency of fn() in milliseconds
+    """
+    for _ in range(num_warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_iters * 1000
+
+
+######################
+# augmentation
+def check_random_shift(aug, x):
+    # fixed shifts, including the boundary shifts of -pad / +pad on each axis
+    pad = aug.pad
+    offsets = torch.tensor([0, 1, pad, 2 * pad - 1, 2 * pad], device=x.device)
+    shift = torch.cartesian_prod(offsets, offsets)
+    x = x[:1].expand(len(shift), *x.shape[1:])
+    n, c, h, w = x.shape
+    
+    # reference: replicate pad and integer (h, w) crop at (y, x) = (shift[:, 1], shift[:, 0])
+    padded = F.pad(x, (pad, pad, pad, pad), 'replicate')
+    reference = torch.stack([padded[idx, :, dy:dy + h, dx:dx + w] for idx, (dx, dy) in enumerate(shift.tolist())])
+    gather_out = aug.shift_by_gather(x, shift)
+    if not torch.equal(gather_out, reference):
+        raise ValueError('shift_by_gather differs from replicate pad + crop')
+    grid_out = aug.shift_by_grid_sample(x, shift)
+    if not torch.allclose(gather_out, grid_out, rtol=0, atol=1e-5):
+        raise ValueError('shift_by_gather differs from shift_by_grid_sample')
+
+
+def benchmark_random_shift(args, device):
+    aug = RandomShiftsAug(pad=4)
+    n, c, h, w = args.batch_size, 9, 84, 84
+    x = torch.rand((n, c, h, w), device=device)
+    check_random_shift(aug, x)
+    shift = torch.randint(0, 2 * aug.pad + 1, size=(n, 2), device=device)
+
+    # same shifts on both paths
+    grid_out = aug.shift_by_grid_sample(x, shift)
+    gather_out = aug.shift_by_gather(x, shift)
+    max_diff = (grid_out - gather_out).abs().max().item()
+    num_mismatch = (grid_out != gather_out).sum().item()
+
+    grid_ms = measure(lambda: aug.shift_by_grid_sample(x, shift), device)
+    gather_ms = measure(lambda: aug.shift_by_gather(x, shift), device)
+    print(f'[random_shift] input: {(n, c, h, w)}, device: {device}')
+    print(f'  grid_sample: {grid_ms:.3f} ms/batch')
+    print(f'  gather:      {gather_ms:.3f} ms/batch ({grid_ms / gather_ms:.1f}x)')
+    print(f'  max abs diff: {max_diff:.3e}, mismatched elements: {num_mismatch}')
+
+
+######################
+# decoding
+def kv_cache_rollout(head, obs, act, dataset_type):
+    """
+    Step-wise decoding with the kv cache: o_1, (a_1), o_2, (a_2), ...
+    [returns] obs, act: decoded features in the layout of head.decode()
+    """
+    t = obs.shape[1]
+    kv_cache = head.init_kv_cache(dataset_type)
+    step_obs, step_act = [], []
+    for idx in range(t):
+        x = head.decode_step(obs[:, idx], 'obs', dataset_type, kv_cache)
+        if dataset_type == 'video':
+            step_obs.append(x)
+        else:
+            step_act.append(x)
+            step_obs.append(head.decode_step(act[:, idx], 'act', dataset_type, kv_cache))
+    step_obs = torch.stack(step_obs, 1)
+    step_act = torch.zeros_like(step_obs) if dataset_type == 'video' else torch.stack(step_act, 1)
+    
+    return step_obs, step_act
+
+
+def check_kv_cache(head, obs, act):
+    # every position of the cached decoding must match decode(..., is_causal=True) on the full sequence
+    for dataset_type in ['video', 'demonstration']:
+        full_obs, full_act = head.decode(obs, act, dataset_type)
+        step_obs, step_act = kv_cache_rollout(head, obs, act, dataset_type)
+        for idx in range(obs.shape[1]):
+            if not (torch.allclose(step_obs[:, idx], full_obs[:, idx], rtol=1e-4, atol=1e-4) and 
+                    torch.allclose(step_act[:, idx], full_act[:, idx], rtol=1e-4, atol=1e-4)):
+                raise ValueError(f'kv cache decoding differs from decode at position {idx} ({dataset_type})')
+
+
+def benchmark_kv_cache(args, device):
+    n, t, d, action_size = args.batch_size, args.t_step, 512, 18
+    head = SimTPRHead(obs_shape=None, action_size=action_size, t_step=t, in_dim=d, 
+                      proj_dim=d, pred_dim=d, proj_bn=False, pred_bn=True, 
+                      num_layers=2, dropout=0.0, checkpoint_activations=False).to(device).eval()
+    obs = torch.randn((n, t, d), device=device)
+    act = torch.randint(0, action_size, size=(n, t), device=device)
+    check_kv_cache(head, obs, act)
+
+    # step-wise decoding by re-running the whole prefix
+    def recompute():
+        x = interleave(obs + head.pos_embed[:, :t], head.act_in(act) + head.pos_embed[:, :t])
+        for idx in range(1, 2 * t + 1):
+            head.decoder(x[:, :idx], is_causal=True)
+
+    recompute_ms = measure(recompute, device, num_warmup=1, num_iters=5)
+    cache_ms = measure(lambda: kv_cache_rollout(head, obs, act, 'demonstration'), device, num_warmup=1, num_iters=5)
+    print(f'[kv_cache] batch: {n}, t_step: {t} ({2 * t} tokens), device: {device}')
+    print(f'  full prefix:   {recompute_ms:.3f} ms/rollout')
+    print(f'  kv cache:      {cache_ms:.3f} ms/rollout ({recompute_ms / cache_ms:.1f}x)')
+    print('  matches full-sequence decode at every position (video, demonstration)')
+
+
+######################
+# activation checkpointing
+def saved_tensor_bytes(fn):
+    """
+    [returns] bytes of the distinct tensors autograd saves for backward while running fn()
+    """
+    saved = {}
+    def pack(x):
+        saved[x.data_ptr()] = x.numel() * x.element_size()
+        return x
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+        out = fn()
+    return out, sum(saved.values())
+
+
+def build_simtpr(args, device, checkpoint_activations=False, channels_last=False, compile_forward=False):
+    """
+    [returns] backbone, head with the default pretraining config, inputs of shape (n, t)
+    """
+    n, t, d, action_size = args.batch_size // args.t_step, args.t_step, 512, 18
+    backbone = Impala(obs_shape=(4, 1, 84, 84), action_size=action_size, 
+                      channels='(16, 32, 32)', strides='(3, 2, 2)', scale_ratio=2, 
+                      expansion_ratio=2, blocks_per_group=3, norm_type='bn', init_type=None, 
+                      renormalize=False, checkpoint_activations=checkpoint_activations, 
+                      channels_last=channels_last, compile_forward=compile_forward).to(device)
+    x = torch.rand((n, t, 4, 1, 84, 84), device=device)
+    head = SimTPRHead(obs_shape=None, action_size=action_size, t_step=t, 
+                      in_dim=backbone(x[:1, :1])[0].shape[-1], proj_dim=d, pred_dim=d, 
+                      proj_bn=False, pred_bn=True, num_layers=2, dropout=0.0, 
+                      checkpoint_activations=checkpoint_activations).to(device)
+    act = torch.randint(0, action_size, size=(n, t), device=device)
+    
+    return backbone, head, x, act
+
+
+def benchmark_checkpoint(args, device):
+    for checkpoint_activations in [False, True]:
+        backbone, head, x, act = build_simtpr(args, device, checkpoint_activations)
+        n, t = act.shape
+        
+        def step():
+            y, _ = backbone(x)
+            obs, act_d = head.decode(head.encode_obs(y), act, 'demonstration')
+            return obs.mean() + act_d.mean()
+        
+        with torch.enable_grad():
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+            loss, num_bytes = saved_tensor_bytes(step)
+            loss.backward()
+            step_ms = measure(lambda: step().backward(), device, num_warmup=2, num_iters=10)
+            
+        print(f'[checkpoint] checkpoint_activations: {checkpoint_activations}, input: {(n, t)}, device: {device}')
+        print(f'  saved activations: {num_bytes / 1024 ** 2:.1f} MB (outside checkpointed segments)')
+        if device.type == 'cuda':
+            print(f'  peak cuda memory:  {torch.cuda.max_memory_allocated(device) / 1024 ** 2:.1f} MB')
+        print(f'  forward + backward: {step_ms:.3f} ms/batch')
+
+
+######################
+# backbone
+def benchmark_impala_fast_path(args, device):
+    ref_backbone, _, x, _ = build_simtpr(args, device)
+    ref_backbone.eval()
+    n, t = x.shape[:2]
+    
+    # batch-1 acting shape and (n t) pretraining shape
+    shapes = {'acting': x[:1, :1], 'pretrain': x}
+    print(f'[impala_fast_path] device: {device}')
+    for channels_last, compile_forward in [(False, False), (True, False), (True, True)]:
+        backbone, _, _, _ = build_simtpr(args, device, channels_last=channels_last, compile_forward=compile_forward)
+        backbone.load_state_dict(ref_backbone.state_dict())
+        backbone.eval()
+        
+        latency = {}
+        max_diff = 0.0
+        for name, inputs in shapes.items():
+            max_diff = max(max_diff, (backbone(inputs)[0] - ref_backbone(inputs)[0]).abs().max().item())
+            latency[name] = measure(lambda: backbone(inputs), device)
+        print(f'  channels_last: {channels_last}, compile_forward: {backbone.compile_forward}')
+        print(f'    acting {tuple(shapes["acting"].shape[:2])}: {latency["acting"]:.3f} ms/batch, '
+              f'pretrain {(n, t)}: {latency["pretrain"]:.3f} ms/batch, max abs diff: {max_diff:.3e}')
+
+
+######################
+# mixed precision
+def benchmark_autocast(args, device):
+    backbone, head, x, act = build_simtpr(args, device)
+    policy = RainbowPolicy(in_dim=head.in_dim, hid_dim=512, action_size=18, 
+                           num_atoms=51, noisy_std=0.5).to(device)
+    n, t = act.shape
+    obs_loss_fn, reg_loss_fn = ConsistencyLoss(), BarlowLoss(0.005)
+    
+    # simplified SimTPR objective: consistency + barlow regularizer
+    def loss_fn():
+        y, _ = backbone(x)
+        z = head.encode_obs(y)
+        obs_d, act_d = head.decode(z[:, :-1], act[:, :-1], 'demonstration')
+        obs_p, _ = head.predict(obs_d, act_d)
+        obs_p, obs_t = obs_p.flatten(0, 1), z[:, 1:].flatten(0, 1)
+        return obs_loss_fn(obs_p, obs_t.detach()) + 0.01 * reg_loss_fn(obs_t, obs_t.roll(1, 0))
+    
+    def step(enabled):
+        with autocast(device, enabled):
+            loss = loss_fn()
+        loss.backward()
+        return loss
+    
+    # eval mode: both precisions see identical batchnorm statistics
+    backbone.eval(), head.eval()
+    with torch.enable_grad():
+        fp32_loss, bf16_loss = step(False).item(), step(True).item()
+    with autocast(device, False):
+        fp32_log_q = policy(backbone(x[:, :1])[0].flatten(0, 1))[1]['log']
+    with autocast(device, True):
+        bf16_log_q = policy(backbone(x[:, :1])[0].flatten(0, 1))[1]['log']
+    
+    backbone.train(), head.train()
+    with torch.enable_grad():
+        fp32_ms = measure(lambda: step(False), device, num_warmup=2, num_iters=10)
+        bf16_ms = measure(lambda: step(True), device, num_warmup=2, num_iters=10)
+    
+    print(f'[autocast] input: {(n, t)}, device: {device}')
+    print(f'  fp32 loss: {fp32_loss:.6f}, bf16 loss: {bf16_loss:.6f} '
+          f'(rel diff {abs(bf16_loss - fp32_loss) / abs(fp32_loss):.2e})')
+    print(f'  rainbow log_q dtype: {bf16_log_q.dtype}, max abs diff: {(fp32_log_q - bf16_log_q).abs().max().item():.3e}')
+    print(f'  fp32: {fp32_ms:.3f} ms/step ({n * t / fp32_ms * 1000:.1f} frames/s)')
+    print(f'  bf16: {bf16_ms:.3f} ms/step ({n * t / bf16_ms * 1000:.1f} frames/s, {fp32_ms / bf16_ms:.2f}x)')
+
+
+######################
+# policy
+def benchmark_noisy_linear(args, device):
+    in_dim, hid_dim = 3136, 512
+    layer = NoisyLinear(in_dim, hid_dim).to(device)
+    x = torch.randn((args.batch_size, in_dim), device=device)
+    
+    # reference: materialized noisy weight
+    def materialized():
+        weight_epsilon = torch.outer(layer.epsilon_out, layer.epsilon_in)
+        weight = layer.weight_mu + layer.weight_sigma * weight_epsilon
+        bias = layer.bias_mu + layer.bias_sigma * layer.epsilon_out
+        return torch.nn.functional.linear(x, weight, bias)
+    
+    def factorised():
+        layer.reset_noise()
+        return layer(x)
+    
+    max_diff = (materialized() - layer(x)).abs().max().item()
+    materialized_ms = measure(lambda: (layer.reset_noise(), materialized()), device)
+    factorised_ms = measure(factorised, device)
+    print(f'[noisy_linear] input: {(args.batch_size, in_dim)}, hidden: {hid_dim}, device: {device}')
+    print(f'  materialized: {materialized_ms:.3f} ms/step')
+    print(f'  factorised:   {factorised_ms:.3f} ms/step ({materialized_ms / factorised_ms:.1f}x)')
+    print(f'  max abs diff: {max_diff:.3e}')
+
+
+def benchmark_dueling(args, device):
+    in_dim, hid_dim, action_size, num_atoms = 3136, 512, 18, 51
+    policy = RainbowPolicy(in_dim=in_dim, hid_dim=hid_dim, action_size=action_size, 
+                           num_atoms=num_atoms, noisy_std=0.5).to(device)
+    # (n, t=1, d): the policy input as passed through the identity head by Model.forward
+    x = torch.randn((args.batch_size, 1, in_dim), device=device)
+    
+    # reference: separate value / advantage streams sharing the fused parameters and noise
+    fc_hid = policy.fc_hid
+    streams = []
+    for k in range(2):
+        layer = NoisyLinear(in_dim, hid_dim).to(device)
+        rows = slice(k * hid_dim, (k + 1) * hid_dim)
+        layer.weight_mu.data.copy_(fc_hid.weight_mu[rows])
+        layer.weight_sigma.data.copy_(fc_hid.weight_sigma[rows])
+        layer.bias_mu.data.copy_(fc_hid.bias_mu[rows])
+        layer.bias_sigma.data.copy_(fc_hid.bias_sigma[rows])
+        layer.epsilon_in.copy_(fc_hid.epsilon_in[k])
+        layer.epsilon_out.copy_(fc_hid.epsilon_out[rows])
+        streams.append(layer)
+    
+    def separate():
+        v = policy.fc_v(torch.relu(streams[0](x))).view(-1, 1, num_atoms)
+        adv = policy.fc_adv(torch.relu(streams[1](x))).view(-1, action_size, num_atoms)
+        return torch.log_softmax(v + adv - adv.mean(1, keepdim=True), -1)
+    
+    print(f'[dueling] input: {tuple(x.shape)}, device: {device}')
+    for mode in ['train', 'eval']:
+        policy.train(mode == 'train'), [layer.train(mode == 'train') for layer in streams]
+        log_q_shape = tuple(policy(x)[1]['log'].shape)
+        if log_q_shape != (args.batch_size, action_size, num_atoms):
+            raise ValueError(f'{mode} mode log_q shape {log_q_shape} for input {tuple(x.shape)}')
+        max_diff = (policy(x)[1]['log'] - separate()).abs().max().item()
+        separate_ms = measure(separate, device)
+        fused_ms = measure(lambda: policy(x), device)
+        print(f'  {mode}: separate {separate_ms:.3f} ms, fused {fused_ms:.3f} ms '
+              f'({separate_ms / fused_ms:.2f}x), max abs diff of log_q: {max_diff:.3e}')
+
+
+def benchmark_inference_export(args, device):
+    backbone, head, x, _ = build_simtpr(args, device)
+    policy = RainbowPolicy(in_dim=head.in_dim, hid_dim=512, action_size=18, 
+                           num_atoms=51, noisy_std=0.5).to(device)
+    model = Model(backbone, head, policy).eval()
+    export_model = export_inference_model(model)
+    
+    print(f'[inference_export] device: {device}')
+    for name, obs in {'acting': x[:1, :1], 'batch': x.flatten(0, 1).unsqueeze(1)}.items():
+        max_diff = (model(obs)[0] - export_model(obs)[0]).abs().max().item()
+        eval_ms = measure(lambda: model(obs), device)
+        export_ms = measure(lambda: export_model(obs), device)
+        print(f'  {name} {tuple(obs.shape[:2])}: eval mode {eval_ms:.3f} ms, exported {export_ms:.3f} ms '
+              f'({eval_ms / export_ms:.2f}x), max abs diff of q: {max_diff:.3e}')
+
+
+def benchmark_int8_actor(args, device):
+    backbone, head, x, _ = build_simtpr(args, device)
+    policy = RainbowPolicy(in_dim=head.in_dim, hid_dim=512, action_size=18, 
+                           num_atoms=51, noisy_std=0.5).to(device)
+    model = Model(backbone, head, policy)
+    support = torch.linspace(-10, 10, 51, device=device)
+    # acting in training: eval mode backbone, noisy policy
+    model.train(), model.backbone.eval()
+    
+    # calibration / agreement on the (n t) observations, latency at the batch-1 acting shape
+    calib_obs = x.flatten(0, 1).unsqueeze(1)
+    obs = calib_obs[:1]
+    q_value = (model(calib_obs)[0] * support).sum(-1)
+    fp32_ms = measure(lambda: model(obs), device)
+    print(f'[int8_actor] acting input: {tuple(obs.shape)}, calibration: {len(calib_obs)}, device: {device}')
+    print(f'  fp32:    {fp32_ms:.3f} ms/step')
+    for quant_type in ['dynamic', 'static']:
+        actor = quantize_actor(model, calib_obs, quant_type)
+        actor_q_value = (actor(calib_obs.cpu())[0] * support.cpu()).sum(-1)
+        max_diff = (q_value.cpu() - actor_q_value).abs().max().item()
+        agreement = (q_value.argmax(1).cpu() == actor_q_value.argmax(1)).float().mean().item()
+        actor_ms = measure(lambda: actor(obs.cpu()), torch.device('cpu'))
+        print(f'  {quant_type}: {actor_ms:.3f} ms/step ({fp32_ms / actor_ms:.2f}x), '
+              f'max abs diff of q: {max_diff:.3e}, greedy action agreement: {agreement:.3f}')
+
+
+BENCHMARKS = {
+    'random_shift': benchmark_random_shift,
+    'kv_cache': benchmark_kv_cache,
+    'checkpoint': benchmark_checkpoint,
+    'impala_fast_path': benchmark_impala_fast_path,
+    'autocast': benchmark_autocast,
+    'noisy_linear': benchmark_noisy_linear,
+    'dueling': benchmark_dueling,
+    'inference_export': benchmark_inference_export,
+    'int8_actor': benchmark_int8_actor,
+}
+
+
+def run(args):
+    args = DotMap(args)
+    device = torch.device(args.device)
+    torch.set_num_threads(args.num_threads)
+
+    targets = list(BENCHMARKS.keys()) if args.target == 'all' else [args.target]
+    for target in targets:
+        with torch.no_grad():
+            BENCHMARKS[target](args, device)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument('--target',      type=str,    default='all')
+    parser.add_argument('--device',      type=str,    default='cpu')
+    parser.add_argument('--num_threads', type=int,    default=1)
+    parser.add_argument('--batch_size',  type=int,    default=256)
+    parser.add_argument('--t_step',      type=int,    default=16)
+    args = parser.parse_args()
+
+    run(vars(args))
@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+from hydra import compose, initialize
+from omegaconf import OmegaConf
+from src.envs import *
+from src.models import *
+from src.models.inference import export_inference_model, GreedyActor
+from dotmap import DotMap
+import torch
+
+
+def run(args):
+    args = DotMap(args)
+    config_dir = args.config_dir
+    config_name = args.config_name
+    overrides = args.overrides
+
+    # Hydra Compose
+    config_path = './configs/' + config_dir
+    initialize(version_base=None, config_path=config_path)
+    cfg = compose(config_name=config_name, overrides=overrides)
+
+    # shape config
+    env, _ = build_env(cfg.env)
+    obs_shape = env.observation_space.shape
+    action_size = env.action_space.n
+    param_dict = {'obs_shape': obs_shape,
+                  'action_size': action_size}
+
+    for key, value in param_dict.items():
+        if key in cfg.model.backbone:
+            cfg.model.backbone[key] = value
+
+        if key in cfg.model.head:
+            cfg.model.head[key] = value
+
+        if key in cfg.model.policy:
+            cfg.model.policy[key] = value
+
+    # the exported graph is traced from the eager forward
+    if 'compile_forward' in cfg.model.backbone:
+        cfg.model.backbone.compile_forward = False
+
+    # model: backbone + head + policy of the checkpoint
+    model = build_model(cfg.model)
+    state_dict = torch.load(args.model_path, map_location='cpu')['model_state_dict']
+    model.load_state_dict(state_dict)
+    actor = GreedyActor(model=export_inference_model(model),
+                        v_min=cfg.agent.v_min,
+                        v_max=cfg.agent.v_max).eval()
+
+    # everything run_rollout.py needs besides the weights
+    config = {'env': OmegaConf.to_container(cfg.env),
+              'obs_shape': list(obs_shape),
+              'action_size': action_size,
+              'eval_eps': cfg.agent.eval_eps}
+
+    # batch-1 acting shape: (1, f, c, h, w) uint8 -> (1,) action
+    obs = torch.zeros((1, *obs_shape), dtype=torch.uint8)
+    os.makedirs(args.output_dir, exist_ok=True)
+    with torch.no_grad():
+        traced_actor = torch.jit.trace(actor, obs)
+        # the traced graph must act like the eager actor
+        obs = torch.randint(0, 256, (1, *obs_shape), dtype=torch.uint8)
+        if not torch.equal(traced_actor(obs), actor(obs)):
+            raise ValueError('traced actor does not match the eager actor')
+        path = os.path.join(args.output_dir, 'actor.pt')
+        torch.jit.save(traced_actor, path, _extra_files={'config.json': json.dumps(config)})
+        print(f'wrote torchscript actor to {path}')
+
+        if args.onnx:
+            path = os.path.join(args.output_dir, 'actor.onnx')
+            torch.onnx.export(actor, obs, path,
+                              input_names=['obs'],
+                              output_names=['action'],
+                              opset_version=args.opset_version)
+            with open(os.path.join(args.output_dir, 'config.json'), 'w') as f:
+                json.dump(config, f)
+            print(f'wrote onnx actor to {path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument('--config_dir',    type=str,    default='atari/finetune')
+    parser.add_argument('--config_name',   type=str,    default='simtpr')
+    parser.add_argument('--model_path',    type=str,    required=True) # {'model_state_dict': ...} checkpoint
+    parser.add_argument('--output_dir',    type=str,    default='./exports')
+    parser.add_argument('--onnx',          action='store_true')
+    parser.add_argument('--opset_version', type=int,    default=17)
+    parser.add_argument('--overrides',     action='append', default=[])
+    args = parser.parse_args()
+
+    run(vars(args))
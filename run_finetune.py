@@ -5,7 +5,7 @@ from src.envs import *
 from src.models import *
 from src.common.logger import WandbAgentLogger
 from src.common.train_utils import set_global_seeds
-from src.agents import build_agent
+from src.agents import build_agent, build_vec_agent
 from typing import List
 from dotmap import DotMap
 import torch
@@ -28,7 +28,11 @@ def run(args):
     device = torch.device(cfg.device)
 
     # environment
-    train_env, eval_env = build_env(cfg.env)
+    # num_seeds > 1: independent seeds trained in this process, each with its own env
+    # seed k of the run uses cfg.seed + k for its env, its model initialization and its checkpoint path
+    num_seeds = cfg.num_seeds
+    envs = [build_env(cfg.env, seed=cfg.seed + seed) for seed in range(num_seeds)]
+    train_env, eval_env = envs[0]
     obs_shape = train_env.observation_space.shape
     action_size = train_env.action_space.n
 
@@ -53,10 +57,15 @@ def run(args):
     logger= WandbAgentLogger(cfg)
 
     # model
-    model = build_model(cfg.model)
+    # the pretrained weights overwrite the whole backbone, its random initialization can be skipped
+    p_cfg = cfg.pretrain
+    defer_backbone_init = p_cfg.use_pretrained and p_cfg.defer_backbone_init
+    models = []
+    for seed in range(num_seeds):
+        set_global_seeds(cfg.seed + seed)
+        models.append(build_model(cfg.model, defer_backbone_init=defer_backbone_init))
 
     # load pretrained
-    p_cfg = cfg.pretrain
     if eval(p_cfg.env) is None:
         p_cfg.env = ''.join(word.title() for word in str(cfg.env.game).split('_'))
 
@@ -68,19 +77,40 @@ def run(args):
             if 'backbone' in name:
                 _state_dict[name] = param
 
-        model.load_state_dict(_state_dict, strict=False)
+        if defer_backbone_init:
+            missing_keys = [name for name in models[0].state_dict() 
+                            if 'backbone' in name and name not in _state_dict]
+            if len(missing_keys) > 0:
+                raise ValueError('defer_backbone_init requires the full backbone state_dict, missing: ' + str(missing_keys))
+
+        for model in models:
+            model.load_state_dict(_state_dict, strict=False)
         
         
     # agent
-    agent = build_agent(cfg=cfg.agent,
-                        device=device,
-                        train_env=train_env,
-                        eval_env=eval_env,
-                        logger=logger,
-                        model=model)
+    if num_seeds == 1:
+        agent = build_agent(cfg=cfg.agent,
+                            device=device,
+                            train_env=train_env,
+                            eval_env=eval_env,
+                            logger=logger,
+                            model=models[0])
+    else:
+        agent = build_vec_agent(cfg=cfg.agent,
+                                device=device,
+                                train_envs=[train_env for train_env, _ in envs],
+                                eval_envs=[eval_env for _, eval_env in envs],
+                                logger=logger,
+                                models=models)
 
     # train
     agent.train()
+    # finetuned model(s) for run_export.py, seed k of a multi-seed run is saved under seed cfg.seed + k
+    if num_seeds == 1:
+        logger.save_state_dict(model=agent.model, name='finetune')
+    else:
+        for seed, model in enumerate(agent.unstack_models()):
+            logger.save_state_dict(model=model, name='finetune', seed=seed)
     wandb.finish()
     return logger
     
@@ -21,6 +21,11 @@ def run(args):
     config_dir = args.config_dir
     config_name = args.config_name
     overrides = args.overrides
+    
+    # overrides written by run_autotune.py
+    if args.overrides_file:
+        with open(args.overrides_file) as f:
+            overrides = [line.strip() for line in f if line.strip() and not line.startswith('#')] + overrides
 
     # Hydra Compose
     config_path = './configs/' + config_dir 
@@ -32,8 +37,10 @@ def run(args):
     device = torch.device(cfg.device)
 
     # dataset
-    torch.set_num_threads(1) # when dataset on disk
+    torch.set_num_threads(cfg.num_threads) # 1 when dataset on disk
     cfg.dataloader.device = cfg.device
+    if cfg.dataloader.worker_aug:
+        cfg.dataloader.aug_types = cfg.trainer.aug_types
     train_loader, eval_act_loader, eval_rew_loader = build_dataloader(cfg.dataloader)
     
     # shape config
@@ -97,6 +104,7 @@ if __name__ == '__main__':
     parser.add_argument('--config_dir',  type=str,    default='atari/pretrain')
     parser.add_argument('--config_name', type=str,    default='simtpr') 
     parser.add_argument('--overrides',   action='append', default=[])
+    parser.add_argument('--overrides_file', type=str, default=None)
     args = parser.parse_args()
 
     run(vars(args))
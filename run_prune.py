@@ -0,0 +1,199 @@
+import argparse
+import copy
+import json
+import os
+import time
+from hydra import compose, initialize
+from omegaconf import OmegaConf
+from src.envs import *
+from src.models import *
+from src.models.inference import export_inference_model, GreedyActor
+from src.models.pruning import bn_channel_scores, activation_channel_scores, prune_impala
+from src.common.logger import WandbAgentLogger
+from src.common.train_utils import set_global_seeds
+from src.agents import build_agent
+from run_rollout import rollout
+from dotmap import DotMap
+import numpy as np
+import torch
+import wandb
+
+
+def collect_observations(actor, env, num_steps):
+    """
+    [returns] observations: (num_steps, f, c, h, w) uint8, visited by the greedy actor
+    """
+    observations = []
+    obs = env.reset()
+    for _ in range(num_steps):
+        observations.append(np.asarray(obs))
+        with torch.no_grad():
+            action = actor(torch.from_numpy(observations[-1]).unsqueeze(0)).item()
+        obs, reward, done, info = env.step(action)
+        if info.traj_done:
+            obs = env.reset()
+
+    return np.stack(observations)
+
+
+def measure_latency(actor, obs, num_warmup=5, num_iters=100):
+    """
+    [returns] mean latency of actor(obs) in milliseconds
+    """
+    with torch.no_grad():
+        for _ in range(num_warmup):
+            actor(obs)
+        start = time.perf_counter()
+        for _ in range(num_iters):
+            actor(obs)
+    return (time.perf_counter() - start) / num_iters * 1000
+
+
+def evaluate(model, cfg, env, obs, num_episodes):
+    actor = GreedyActor(model=export_inference_model(model.cpu()),
+                        v_min=cfg.agent.v_min,
+                        v_max=cfg.agent.v_max).eval()
+    scores = rollout(actor, env, cfg.agent.action_size, cfg.agent.eval_eps, num_episodes)
+    result = {'params': sum(p.numel() for p in model.backbone.parameters()),
+              'latency_ms': measure_latency(actor, obs),
+              'score': float(np.mean(scores))}
+
+    return result
+
+
+def prune_game(args, cfg):
+    set_global_seeds(cfg.seed)
+    device = torch.device(cfg.device)
+    game = cfg.env.game
+
+    # environment
+    train_env, eval_env = build_env(cfg.env)
+    obs_shape = train_env.observation_space.shape
+    action_size = train_env.action_space.n
+    param_dict = {'obs_shape': obs_shape,
+                  'action_size': action_size}
+
+    for key, value in param_dict.items():
+        if key in cfg.model.backbone:
+            cfg.model.backbone[key] = value
+
+        if key in cfg.model.head:
+            cfg.model.head[key] = value
+
+        if key in cfg.model.policy:
+            cfg.model.policy[key] = value
+
+        if key in cfg.agent:
+            cfg.agent[key] = value
+
+    # the exported actors are run eagerly
+    if 'compile_forward' in cfg.model.backbone:
+        cfg.model.backbone.compile_forward = False
+
+    # finetuned model
+    model = build_model(cfg.model)
+    state_dict = torch.load(args.model_path.format(game=game), map_location='cpu')['model_state_dict']
+    model.load_state_dict(state_dict)
+
+    # channel importance on observations visited by the finetuned agent
+    actor = GreedyActor(model=export_inference_model(model),
+                        v_min=cfg.agent.v_min,
+                        v_max=cfg.agent.v_max).eval()
+    observations = collect_observations(actor, eval_env, args.num_calib_steps)
+    observations = torch.from_numpy(observations).float().div(255.0).unsqueeze(1)
+    if args.criterion == 'bn':
+        stream_scores, hidden_scores = bn_channel_scores(model.backbone)
+    elif args.criterion == 'activation':
+        stream_scores, hidden_scores = activation_channel_scores(model.backbone, observations.split(args.batch_size))
+    else:
+        raise ValueError('unknown criterion: ' + str(args.criterion))
+
+    # pruned model: same architecture with the reduced channels
+    pruned_state_dict, channels = prune_impala(model, stream_scores, hidden_scores, args.keep_ratio)
+    pruned_cfg = copy.deepcopy(cfg)
+    pruned_cfg.model.backbone.channels = str(channels)
+    pruned_cfg.model.backbone.scale_ratio = 1
+    pruned_model = build_model(pruned_cfg.model)
+    pruned_model.load_state_dict(pruned_state_dict)
+
+    # optional short finetuning of the pruned model
+    if args.finetune_steps > 0:
+        pruned_cfg.agent.num_timesteps = args.finetune_steps
+        logger = WandbAgentLogger(pruned_cfg)
+        agent = build_agent(cfg=pruned_cfg.agent,
+                            device=device,
+                            train_env=train_env,
+                            eval_env=eval_env,
+                            logger=logger,
+                            model=pruned_model)
+        agent.train()
+        wandb.finish()
+        pruned_model = agent.model
+
+    # pruned checkpoint and its backbone config
+    output_dir = os.path.join(args.output_dir, game)
+    os.makedirs(output_dir, exist_ok=True)
+    torch.save({'model_state_dict': pruned_model.state_dict()}, os.path.join(output_dir, 'model.pth'))
+    backbone_cfg = OmegaConf.to_container(pruned_cfg.model.backbone)
+    backbone_cfg['obs_shape'], backbone_cfg['action_size'] = None, None
+    OmegaConf.save(OmegaConf.create(backbone_cfg), os.path.join(output_dir, 'backbone.yaml'))
+
+    # speed / score trade-off
+    obs = torch.from_numpy(np.asarray(eval_env.reset())).unsqueeze(0)
+    result = {'game': game,
+              'channels': str(channels),
+              'original': evaluate(model, cfg, eval_env, obs, args.num_eval_episodes),
+              'pruned': evaluate(pruned_model, pruned_cfg, eval_env, obs, args.num_eval_episodes)}
+    print(result)
+
+    return result
+
+
+def run(args):
+    args = DotMap(args)
+    config_dir = args.config_dir
+    config_name = args.config_name
+    overrides = args.overrides
+
+    # Hydra Compose
+    config_path = './configs/' + config_dir
+    initialize(version_base=None, config_path=config_path)
+    games = eval(args.games)
+    if len(games) == 0:
+        games = [compose(config_name=config_name, overrides=overrides).env.game]
+
+    results = []
+    for game in games:
+        cfg = compose(config_name=config_name, overrides=overrides + ['env.game=' + game])
+        results.append(prune_game(args, cfg))
+
+    # per-game report
+    print(f'keep_ratio: {args.keep_ratio}, criterion: {args.criterion}, finetune_steps: {args.finetune_steps}')
+    for result in results:
+        original, pruned = result['original'], result['pruned']
+        print(f"  {result['game']}: channels {result['channels']}, "
+              f"params {original['params']} -> {pruned['params']}, "
+              f"latency {original['latency_ms']:.3f} -> {pruned['latency_ms']:.3f} ms "
+              f"({original['latency_ms'] / pruned['latency_ms']:.2f}x), "
+              f"score {original['score']:.1f} -> {pruned['score']:.1f}")
+    with open(os.path.join(args.output_dir, 'results.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument('--config_dir',        type=str,    default='atari/finetune')
+    parser.add_argument('--config_name',       type=str,    default='simtpr')
+    parser.add_argument('--games',             type=str,    default='[]') # [] uses the configured env.game
+    parser.add_argument('--model_path',        type=str,    default='./models/simtpr_ft/{game}/0/finetune/model.pth')
+    parser.add_argument('--criterion',         type=str,    default='activation', choices=['activation', 'bn'])
+    parser.add_argument('--keep_ratio',        type=float,  default=0.5)
+    parser.add_argument('--num_calib_steps',   type=int,    default=2000)
+    parser.add_argument('--batch_size',        type=int,    default=256)
+    parser.add_argument('--finetune_steps',    type=int,    default=0) # 0: no finetuning after pruning
+    parser.add_argument('--num_eval_episodes', type=int,    default=10)
+    parser.add_argument('--output_dir',        type=str,    default='./pruned')
+    parser.add_argument('--overrides',         action='append', default=[])
+    args = parser.parse_args()
+
+    run(vars(args))
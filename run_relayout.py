@@ -0,0 +1,44 @@
+import argparse
+from hydra import compose, initialize
+from src.dataloaders import build_loader_cfgs
+from src.common.data_utils import relayout_replay_dataset
+from dotmap import DotMap
+
+
+def run(args):
+    args = DotMap(args)
+    config_dir = args.config_dir
+    config_name = args.config_name
+    overrides = args.overrides
+
+    # Hydra Compose
+    config_path = './configs/' + config_dir
+    initialize(version_base=None, config_path=config_path)
+    cfg = compose(config_name=config_name, overrides=overrides)
+
+    # relayout reads the source windows from the memmapped .npy files
+    cfg.dataloader.device = 'cpu'
+    cfg.dataloader.dataset_on_gpu = False
+    cfg.dataloader.dataset_on_disk = True
+    cfg.dataloader.layout = 'random'
+    loader, train_cfg, eval_act_cfg, eval_rew_cfg = build_loader_cfgs(cfg.dataloader)
+
+    for loader_cfg in [train_cfg, eval_act_cfg, eval_rew_cfg]:
+        replay_loader = loader(**loader_cfg)
+        dataset = replay_loader.get_dataset()
+        relayout_replay_dataset(dataset=dataset,
+                                relayout_path=replay_loader.relayout_path,
+                                block_size=args.block_size,
+                                seed=args.seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument('--config_dir',  type=str,    default='atari/pretrain')
+    parser.add_argument('--config_name', type=str,    default='simtpr')
+    parser.add_argument('--block_size',  type=int,    default=256)
+    parser.add_argument('--seed',        type=int,    default=0)
+    parser.add_argument('--overrides',   action='append', default=[])
+    args = parser.parse_args()
+
+    run(vars(args))
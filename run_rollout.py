@@ -0,0 +1,81 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import types
+import numpy as np
+import torch
+
+# the rollout only needs torch and AtariEnv: src/envs/__init__.py (build_env from the hydra configs, omegaconf)
+# is skipped by registering the package path directly, unless src.envs is already imported
+_envs = types.ModuleType('src.envs')
+_envs.__path__ = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src', 'envs')]
+sys.modules.setdefault('src.envs', _envs)
+from src.envs.atari import AtariEnv
+
+
+def rollout(actor, env, action_size, eval_eps, num_episodes, verbose=False):
+    """
+    [params] actor: (1, f, c, h, w) uint8 observation -> (1,) greedy action
+    [returns] scores: game score per episode
+    """
+    scores = []
+    for episode in range(num_episodes):
+        obs = env.reset()
+        score = 0.0
+        while True:
+            # eps-greedy, as in BaseAgent.evaluate
+            if random.random() < eval_eps:
+                action = random.randint(0, action_size - 1)
+            else:
+                with torch.no_grad():
+                    action = actor(torch.from_numpy(np.asarray(obs)).unsqueeze(0)).item()
+
+            obs, reward, done, info = env.step(action)
+            score += float(info.game_score)
+            if info.traj_done:
+                break
+
+        scores.append(score)
+        if verbose:
+            print(f'episode {episode}: {score:.1f}')
+
+    return scores
+
+
+def run(args):
+    """
+    Greedy evaluation of an actor exported by run_export.py, with only torch and the atari env.
+    """
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.num_threads)
+
+    # actor and its env config
+    extra_files = {'config.json': ''}
+    actor = torch.jit.load(args.actor_path, map_location='cpu', _extra_files=extra_files)
+    config = json.loads(extra_files['config.json'])
+    env_cfg = config['env']
+    env_cfg.pop('type')
+    env = AtariEnv(seed=args.seed, **env_cfg)
+    action_size = config['action_size']
+    eval_eps = config['eval_eps'] if args.eval_eps is None else args.eval_eps
+
+    start = time.time()
+    scores = rollout(actor, env, action_size, eval_eps, args.num_episodes, verbose=True)
+    print(f'mean score over {len(scores)} episodes: {np.mean(scores):.2f} (std {np.std(scores):.2f}), '
+          f'{time.time() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument('--actor_path',   type=str,    default='./exports/actor.pt')
+    parser.add_argument('--num_episodes', type=int,    default=100)
+    parser.add_argument('--eval_eps',     type=float,  default=None) # None: eval_eps of the exported config
+    parser.add_argument('--seed',         type=int,    default=0)
+    parser.add_argument('--num_threads',  type=int,    default=1)
+    args = parser.parse_args()
+
+    run(args)
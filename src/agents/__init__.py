@@ -1,4 +1,5 @@
 from .base import BaseAgent
+from .vec_rainbow import VecRAINBOW
 from .buffers import *
 from dotmap import DotMap
 from omegaconf import OmegaConf
@@ -49,3 +50,43 @@ def build_agent(cfg,
                  buffer=buffer,
                  aug_func=aug_func,
                  model=model)
+
+
+def build_vec_agent(cfg,
+                    device,
+                    train_envs,
+                    eval_envs,
+                    logger,
+                    models):
+    """
+    K seeds of the agent in a single process, one (env, buffer, model) per seed
+    """
+    cfg = DotMap(OmegaConf.to_container(cfg))
+
+    # augemntation
+    if len(cfg.aug_types) == 0:
+        cfg.aug_types = []
+    aug_func = Augmentation(obs_shape=cfg.obs_shape, 
+                            aug_types=cfg.aug_types)
+
+    # buffer
+    buffer_cfg = cfg.pop('buffer')
+    buffer_type = buffer_cfg.pop('type')
+    if buffer_type == 'feature_per_buffer':
+        raise ValueError('feature_per_buffer is not supported for multi-seed training')
+    if cfg.quantize_actor:
+        raise ValueError('quantize_actor is not supported for multi-seed training')
+    buffer = BUFFERS[buffer_type]
+    buffers = [buffer(device=device, gamma=cfg['gamma'], **buffer_cfg) for _ in models]
+
+    agent_type = cfg.pop('type')
+    if agent_type != 'rainbow':
+        raise ValueError('multi-seed training is only supported for rainbow')
+    return VecRAINBOW(cfg=cfg,
+                      device=device,
+                      train_envs=train_envs,
+                      eval_envs=eval_envs,
+                      logger=logger,
+                      buffers=buffers,
+                      aug_func=aug_func,
+                      models=models)
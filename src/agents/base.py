@@ -4,7 +4,22 @@ import torch.optim as optim
 import tqdm
 import random
 from abc import *
+from collections import deque
 from typing import Tuple
+from src.common.train_utils import autocast
+from src.models.inference import export_inference_model
+
+
+def build_optimizer(param_group, optimizer_cfg):
+    optimizer_type = optimizer_cfg.pop('type')
+    if optimizer_type == 'adam':
+        return optim.Adam(param_group, 
+                          **optimizer_cfg)
+    elif optimizer_type == 'rmsprop':
+        return optim.RMSprop(param_group, 
+                             **optimizer_cfg)
+    else:
+        raise ValueError
 
 
 class BaseAgent(metaclass=ABCMeta):
@@ -32,21 +47,23 @@ class BaseAgent(metaclass=ABCMeta):
             for param in self.model.backbone.parameters():
                 param.requires_grad = False
         self.optimizer = self._build_optimizer(self.model.parameters(), cfg.optimizer)
+        
+        # int8 copy of the model for action selection on cpu, 
+        # rebuilt from the learner every actor_refresh_freq steps and calibrated on recent observations
+        self.actor = None
+        if self.cfg.quantize_actor:
+            if self.device.type != 'cpu':
+                raise ValueError('quantize_actor requires device: cpu')
+            if self.cfg.eval_backbone_mode != 'eval':
+                raise ValueError('quantize_actor requires eval_backbone_mode: eval to fold the batchnorm')
+            self.calib_obs = deque(maxlen=self.cfg.actor_num_calibration)
 
     @classmethod
     def get_name(cls):
         return cls.name
 
     def _build_optimizer(self, param_group, optimizer_cfg):
-        optimizer_type = optimizer_cfg.pop('type')
-        if optimizer_type == 'adam':
-            return optim.Adam(param_group, 
-                              **optimizer_cfg)
-        elif optimizer_type == 'rmsprop':
-            return optim.RMSprop(param_group, 
-                                 **optimizer_cfg)
-        else:
-            raise ValueError
+        return build_optimizer(param_group, optimizer_cfg)
     
     @abstractmethod
     def predict(self, obs, mode) -> torch.Tensor:
@@ -64,6 +81,14 @@ class BaseAgent(metaclass=ABCMeta):
     def reset(self):
         pass
     
+    def refresh_actor(self, calib_obs) -> dict:
+        """
+        Rebuilds self.actor from the current model weights and modes.
+        No-op for agents without an int8 actor: self.actor stays None and the model acts.
+        [returns] log_data: agreement of the actor with the model on calib_obs
+        """
+        return {}
+    
     def train(self):
         obs = self.train_env.reset()
         for t in tqdm.tqdm(range(1, self.cfg.num_timesteps+1)):
@@ -73,6 +98,12 @@ class BaseAgent(metaclass=ABCMeta):
                 self.model.backbone.eval()
             
             obs_tensor = self.buffer.encode_obs(obs, prediction=True)
+            if self.cfg.quantize_actor:
+                self.calib_obs.append(obs_tensor)
+                if (t >= self.cfg.min_buffer_size) & ((t - self.cfg.min_buffer_size) % self.cfg.actor_refresh_freq == 0):
+                    log_data = self.refresh_actor(torch.cat(list(self.calib_obs)))
+                    self.logger.update_log(mode='train', **log_data)
+            
             if t < self.cfg.min_buffer_size:
                 action = random.randint(0, self.cfg.action_size - 1)
             else:
@@ -87,13 +118,20 @@ class BaseAgent(metaclass=ABCMeta):
             if (t >= self.cfg.min_buffer_size) & (t % self.cfg.optimize_freq == 0):
                 for _ in range(self.cfg.optimize_per_step):
                     self.optimizer.zero_grad()
-                    loss, log_data = self.compute_loss()
+                    with autocast(self.device, self.cfg.autocast):
+                        loss, log_data = self.compute_loss()
                     loss.backward()
                     torch.nn.utils.clip_grad_norm_(self.model.parameters(), 
                                                    self.cfg.clip_grad_norm)
                     self.optimizer.step()
                     self.logger.update_log(mode='train', **log_data)
                 
+                # the actor's NoisyLinear keeps the noise of its rebuild, 
+                # rebuilding after every update follows the per-update noise of the fp32 model
+                if self.cfg.quantize_actor and self.cfg.actor_resample_noise:
+                    log_data = self.refresh_actor(torch.cat(list(self.calib_obs)))
+                    self.logger.update_log(mode='train', **log_data)
+                
             # evaluate
             if t % self.cfg.eval_every == 0:
                 self.evaluate()
@@ -119,6 +157,14 @@ class BaseAgent(metaclass=ABCMeta):
 
     def evaluate(self):
         self.model.eval()
+        # greedy (eval mode) actor for the evaluation, the training actor is restored afterwards
+        train_actor = self.actor
+        if self.cfg.quantize_actor and len(self.calib_obs) > 0:
+            log_data = self.refresh_actor(torch.cat(list(self.calib_obs)))
+            self.logger.update_log(mode='eval', **log_data)
+        else:
+            self.actor = export_inference_model(self.model)
+        
         for _ in tqdm.tqdm(range(self.cfg.num_eval_trajectories)):
             obs = self.eval_env.reset()
             while True:
@@ -141,5 +187,6 @@ class BaseAgent(metaclass=ABCMeta):
                 else:
                     obs = next_obs
         
+        self.actor = train_actor
         self.logger.write_log(mode='eval')
 
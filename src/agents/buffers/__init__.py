@@ -1,6 +1,7 @@
 from .base import BaseBuffer
 from .per_buffer import PERBuffer
+from .feature_per_buffer import FeaturePERBuffer
 
 __all__ = [
-    'BaseBuffer', 'PERBuffer'
+    'BaseBuffer', 'PERBuffer', 'FeaturePERBuffer'
 ]
\ No newline at end of file
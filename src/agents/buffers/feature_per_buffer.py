@@ -0,0 +1,72 @@
+import torch
+import numpy as np
+from .per_buffer import PERBuffer
+from einops import rearrange
+
+
+class FeaturePERBuffer(PERBuffer):
+    name = 'feature_per_buffer'
+    def __init__(self, size, n_step, gamma, prior_exp, prior_weight_scheduler, num_views, device):
+        """
+        Prioritized replay of frozen-backbone features instead of observations.
+        Features are computed once when a transition is stored, so the learner only runs head & policy.
+        With augmentation, num_views augmented variants are cached per observation and 
+        one of them is drawn at sampling time.
+        """
+        super().__init__(size, n_step, gamma, prior_exp, prior_weight_scheduler, device)
+        self.num_views = num_views
+        self.encoder = None
+        self.aug_func = None
+        self._last_next_obs = None
+        self._last_next_feature = None
+
+    def set_encoder(self, encoder, aug_func):
+        """
+        [params] encoder: (n, 1, f, c, h, w) -> (n, 1, d), frozen backbone in eval mode
+        [params] aug_func: Augmentation or None (a single un-augmented view is cached)
+        """
+        self.encoder = encoder
+        self.aug_func = aug_func
+        if aug_func is None:
+            self.num_views = 1
+
+    def _encode_feature(self, obs):
+        """
+        [returns] feature: (num_views, d) float16
+        """
+        x = self.encode_obs(obs, prediction=True)
+        x = x.repeat(self.num_views, 1, 1, 1, 1, 1)
+        if self.aug_func is not None:
+            n, t, f, c, h, w = x.shape
+            x = rearrange(x, 'n t f c h w -> n (t f c) h w')
+            x = self.aug_func(x)
+            x = rearrange(x, 'n (t f c) h w -> n t f c h w', t=t, f=f, c=c)
+        with torch.no_grad():
+            feature = self.encoder(x)
+        
+        return feature.reshape(self.num_views, -1).half().cpu().numpy()
+
+    def store(self, obs, action, reward, done, next_obs):
+        # obs is the next_obs of the previous step unless the environment was reset
+        if obs is self._last_next_obs:
+            obs_feature = self._last_next_feature
+        else:
+            obs_feature = self._encode_feature(obs)
+        next_obs_feature = self._encode_feature(next_obs)
+        self._last_next_obs = next_obs
+        self._last_next_feature = next_obs_feature
+        
+        super().store(obs_feature, action, reward, done, next_obs_feature)
+
+    def encode_batch(self, features):
+        """
+        [params] features: n cached features of shape (num_views, d)
+        [returns] x: (n, 1, d), one randomly drawn view per sample
+        """
+        features = np.stack(features)
+        n = len(features)
+        views = np.random.randint(self.num_views, size=n)
+        x = features[np.arange(n), views].astype(np.float32)
+        x = torch.from_numpy(x).to(self.device)
+
+        return x.unsqueeze(1)
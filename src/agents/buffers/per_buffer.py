@@ -149,11 +149,11 @@ class PERBuffer(BaseBuffer):
 
         # encode transitions
         obs_batch, act_batch, return_batch, done_batch, next_obs_batch = zip(*transitions)
-        obs_batch = self.encode_obs(obs_batch)  
+        obs_batch = self.encode_batch(obs_batch)  
         act_batch = torch.LongTensor(act_batch).to(self.device)
         return_batch = torch.FloatTensor(return_batch).to(self.device)
         done_batch = torch.FloatTensor(done_batch).to(self.device)
-        next_obs_batch = self.encode_obs(next_obs_batch)
+        next_obs_batch = self.encode_batch(next_obs_batch)
 
         # compute importance weights
         p_total = self.transitions.total()
@@ -199,6 +199,9 @@ class PERBuffer(BaseBuffer):
 
         return obs
 
+    def encode_batch(self, obs):
+        return self.encode_obs(obs)
+
     def update_priorities(self, idxs, priorities):
         priorities = np.power(priorities, self.prior_exp)
         self.transitions.update(idxs, priorities)
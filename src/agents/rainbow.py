@@ -1,5 +1,7 @@
 from .base import BaseAgent
 from src.common.train_utils import LinearScheduler
+from src.models.inference import quantize_actor
+from .buffers import PERBuffer
 from einops import rearrange
 import torch
 import torch.nn as nn
@@ -8,6 +10,79 @@ import random
 import copy
 
 
+######################
+# C51 update, shared with VecRAINBOW: the leading dims are (n,) or (k, n) for k seeds
+def gather_action(q_dist, act):
+    """
+    [params] q_dist: (..., a, num_atoms)
+    [params] act: (...) action indices
+    [returns] q_dist: (..., num_atoms) distribution of the given actions
+    """
+    act_idx = act.reshape(*q_dist.shape[:-2], 1, 1).expand(*q_dist.shape[:-2], 1, q_dist.shape[-1])
+    return q_dist.gather(-2, act_idx).squeeze(-2)
+
+
+def greedy_target_dist(next_target_q_dist, next_q_dist, support):
+    """
+    [params] next_target_q_dist: (..., a, num_atoms) target model on next_obs
+    [params] next_q_dist: (..., a, num_atoms) selects the next action (online model with double, target model otherwise)
+    [returns] target_q_dist: (..., num_atoms) target model distribution of the greedy next action
+    """
+    next_q = (next_q_dist * support).sum(-1)
+    return gather_action(next_target_q_dist, torch.argmax(next_q, -1))
+
+
+def project_target_dist(target_q_dist, return_batch, done_batch, support, gamma, n_step):
+    """
+    C51 (https://arxiv.org/abs/1707.06887, Algorithm 1): L2-projection of Tz = R_n + (γ^n)Z on the support
+    [params] target_q_dist: (..., num_atoms)
+    [params] return_batch, done_batch: (...) n-step return and done of the buffer samples
+    [returns] m: (..., num_atoms) fp32
+    """
+    # the projection is kept in fp32 under autocast
+    with torch.autocast(device_type=support.device.type, enabled=False):
+        num_atoms = len(support)
+        v_min, v_max = support[0].item(), support[-1].item()
+        delta_z = (v_max - v_min) / (num_atoms - 1)
+        
+        # Tz = R_n + (γ^n)Z (w/ n-step return) (N, N_A)
+        shape = target_q_dist.shape
+        target_q_dist = target_q_dist.float().reshape(-1, num_atoms)
+        Tz = (return_batch.reshape(-1, 1) + 
+              (gamma ** n_step) * support.unsqueeze(0) * (1-done_batch.reshape(-1, 1)))
+        Tz = Tz.clamp(min=v_min, max=v_max)
+        b = (Tz - v_min) / delta_z
+        l, u = b.floor().to(torch.int64), b.ceil().to(torch.int64)
+        l[(u > 0) * (l == u)] -= 1
+        u[(l < (num_atoms - 1)) * (l == u)] += 1
+
+        # Distribute probability of Tz
+        # row offsets let a single index_add_ accumulate repeated indices of every row
+        offset = (torch.arange(len(Tz), device=Tz.device) * num_atoms).unsqueeze(1)
+        m = torch.zeros(Tz.numel(), device=Tz.device)
+        m.index_add_(0, (l + offset).view(-1), (target_q_dist * (u - b)).view(-1))
+        m.index_add_(0, (u + offset).view(-1), (target_q_dist * (b - l)).view(-1))
+    
+    return m.view(shape)
+
+
+def c51_loss(log_pred_q_dist, m, weights):
+    """
+    [params] log_pred_q_dist, m: (..., n, num_atoms)
+    [params] weights: (..., n) importance sampling weights
+    [returns] kl_div: (..., n) cross-entropy to the projected target, the new priorities
+              loss: (...) weighted mean over the batch
+    """
+    kl_div = -torch.sum(m * log_pred_q_dist, -1)
+    return kl_div, (kl_div * weights).mean(-1)
+
+
+def update_priorities(buffer, idxs, kl_div):
+    # also covers the feature_per_buffer subclass
+    if isinstance(buffer, PERBuffer):
+        buffer.update_priorities(idxs=idxs, priorities=kl_div.detach().cpu().numpy())
+
+
 class RAINBOW(BaseAgent):
     name = 'rainbow'
     def __init__(self,
@@ -21,7 +96,13 @@ class RAINBOW(BaseAgent):
                  model):
         
         super().__init__(cfg, device, train_env, eval_env, logger, buffer, aug_func, model)  
-        self.target_model = copy.deepcopy(self.model).to(self.device)   
+        # a frozen backbone in eval mode is the same fixed function for the online and target model:
+        # the target model shares it instead of holding a copy
+        self.frozen_backbone = (self.cfg.finetune_type == 'freeze' and 
+                                self.cfg.train_backbone_mode == 'eval' and 
+                                self.cfg.train_target_backbone_mode == 'eval')
+        memo = {id(self.model.backbone): self.model.backbone} if self.frozen_backbone else {}
+        self.target_model = copy.deepcopy(self.model, memo).to(self.device)   
         self.target_model.load_state_dict(self.model.state_dict())
         for param in self.target_model.parameters():
             param.requires_grad = False
@@ -33,8 +114,23 @@ class RAINBOW(BaseAgent):
         self.support = torch.linspace(self.v_min, self.v_max, self.num_atoms).to(self.device)
         self.delta_z = (self.v_max - self.v_min) / (self.num_atoms - 1)
 
+        # replay of cached backbone features, valid only if the backbone is a fixed function
+        if self.buffer.name == 'feature_per_buffer':
+            if not self.frozen_backbone:
+                raise ValueError('feature_per_buffer requires a frozen backbone in eval mode')
+            aug_func = self.aug_func if len(self.cfg.aug_types) > 0 else None
+            self.buffer.set_encoder(encoder=self._encode_features, aug_func=aug_func)
+            
+    def _encode_features(self, obs):
+        training = self.model.backbone.training
+        self.model.backbone.eval()
+        x, _ = self.model.backbone(obs)
+        self.model.backbone.train(training)
+        return x
+
     def predict(self, obs, mode) -> torch.Tensor:
-        q_dist, _ = self.model(obs)
+        model = self.model if self.actor is None else self.actor
+        q_dist, _ = model(obs)
         q_value = (q_dist * self.support.reshape(1,1,-1)).sum(-1)
         argmax_action = torch.argmax(q_value, 1).item()
         
@@ -52,8 +148,25 @@ class RAINBOW(BaseAgent):
         
         return action
     
+    def refresh_actor(self, calib_obs):
+        self.actor = quantize_actor(self.model, calib_obs, self.cfg.actor_quant_type)
+        
+        # agreement with the fp32 q-values
+        with torch.no_grad():
+            q_value = (self.model(calib_obs)[0] * self.support.reshape(1,1,-1)).sum(-1)
+            actor_q_value = (self.actor(calib_obs)[0] * self.support.reshape(1,1,-1)).sum(-1)
+        log_data = {
+            'actor_q_max_diff': (q_value - actor_q_value).abs().max().item(),
+            'actor_act_agreement': (q_value.argmax(1) == actor_q_value.argmax(1)).float().mean().item()
+        }
+        return log_data
+    
     def update(self):
-        self.target_model.load_state_dict(self.model.state_dict())
+        if self.frozen_backbone:
+            self.target_model.head.load_state_dict(self.model.head.state_dict())
+            self.target_model.policy.load_state_dict(self.model.policy.state_dict())
+        else:
+            self.target_model.load_state_dict(self.model.state_dict())
         
     def reset(self):
         self.model.policy.reset_parameter()
@@ -78,13 +191,26 @@ class RAINBOW(BaseAgent):
         next_obs_batch = sample_dict['next_obs']
         weights = sample_dict['weights']
         
-        # augment the observation if needed
-        n, t, f, c, h, w = obs_batch.shape
-        obs_batch = rearrange(obs_batch, 'n t f c h w -> n (t f c) h w')
-        next_obs_batch = rearrange(next_obs_batch, 'n t f c h w -> n (t f c) h w')
-        obs_batch, next_obs_batch = self.aug_func(obs_batch), self.aug_func(next_obs_batch)
-        obs_batch = rearrange(obs_batch, 'n (t f c) h w -> n t f c h w', t=t, f=f, c=c)
-        next_obs_batch = rearrange(next_obs_batch, 'n (t f c) h w -> n t f c h w', t=t, f=f, c=c)
+        # cached features: (n, 1, d), already augmented at insertion
+        if self.buffer.name == 'feature_per_buffer':
+            model, target_model = self.model.forward_from_features, self.target_model.forward_from_features
+        else:
+            model, target_model = self.model, self.target_model
+            
+            # augment the observation if needed
+            n, t, f, c, h, w = obs_batch.shape
+            obs_batch = rearrange(obs_batch, 'n t f c h w -> n (t f c) h w')
+            next_obs_batch = rearrange(next_obs_batch, 'n t f c h w -> n (t f c) h w')
+            obs_batch, next_obs_batch = self.aug_func([obs_batch, next_obs_batch]).chunk(2)
+            obs_batch = rearrange(obs_batch, 'n (t f c) h w -> n t f c h w', t=t, f=f, c=c)
+            next_obs_batch = rearrange(next_obs_batch, 'n (t f c) h w -> n t f c h w', t=t, f=f, c=c)
+        
+            # shared frozen backbone: one embedding pass over obs and next_obs for the online and target model
+            if self.frozen_backbone:
+                with torch.no_grad():
+                    x, _ = self.model.backbone(torch.cat([obs_batch, next_obs_batch]))
+                obs_batch, next_obs_batch = x.chunk(2)
+                model, target_model = self.model.forward_from_features, self.target_model.forward_from_features
         
         # reset noise
         self.model.policy.reset_noise()
@@ -93,54 +219,31 @@ class RAINBOW(BaseAgent):
         # Calculate current state's q-value distribution
         # cur_online_log_q_dist: (N, A, N_A = num_atoms)
         # log_pred_q_dist: (N, N_A)
-        _, model_log = self.model(obs_batch)
-        cur_online_log_q_dist = model_log['policy']['log']
-        act_idx = act_batch.reshape(-1,1,1).repeat(1,1,self.num_atoms)
-        log_pred_q_dist = cur_online_log_q_dist.gather(1, act_idx).squeeze(1)
+        # the online obs / next_obs forwards are not fused into one 2n-batch call:
+        # the backward would then run over the next_obs half as well,
+        # and batchnorm would need per-half statistics to keep its train-mode semantics
+        _, model_log = model(obs_batch)
+        log_pred_q_dist = gather_action(model_log['policy']['log'], act_batch)
 
         with torch.no_grad():
             # Calculate n-th next state's q-value distribution
             # next_target_q_dist: (n, a, num_atoms)
             # target_q_dist: (n, num_atoms)
-            next_target_q_dist, _ = self.target_model(next_obs_batch)
+            next_target_q_dist, _ = target_model(next_obs_batch)
             if self.cfg.double:
-                next_online_q_dist, _ = (self.model(next_obs_batch))
-                next_online_q =  (next_online_q_dist * self.support.reshape(1,1,-1)).sum(-1)
-                next_act = torch.argmax(next_online_q, 1)
-            else:       
-                next_target_q =  (next_target_q_dist * self.support.reshape(1,1,-1)).sum(-1)     
-                next_act = torch.argmax(next_target_q, 1)  
-            next_act_idx = next_act.reshape(-1,1,1).repeat(1,1,self.num_atoms)
-            target_q_dist = next_target_q_dist.gather(1, next_act_idx).squeeze(1)
+                # online next_obs forward without grad: no activations kept for backward
+                next_online_q_dist, _ = model(next_obs_batch)
+                target_q_dist = greedy_target_dist(next_target_q_dist, next_online_q_dist, self.support)
+            else:
+                target_q_dist = greedy_target_dist(next_target_q_dist, next_target_q_dist, self.support)
+            m = project_target_dist(target_q_dist, return_batch, done_batch, 
+                                    self.support, self.cfg.gamma, self.buffer.n_step)
         
-            # C51 (https://arxiv.org/abs/1707.06887, Algorithm 1)
-            # Compute the projection 
-            # Tz = R_n + (γ^n)Z (w/ n-step return) (N, N_A)
-            gamma = (self.cfg.gamma ** self.buffer.n_step)
-            Tz = return_batch.unsqueeze(-1) + gamma * self.support.unsqueeze(0) * (1-done_batch).unsqueeze(-1)
-            Tz = Tz.clamp(min=self.v_min, max=self.v_max)
-            # L2-projection
-            b = (Tz - self.v_min) / self.delta_z
-            l, u = b.floor().to(torch.int64), b.ceil().to(torch.int64)
-            l[(u > 0) * (l == u)] -= 1
-            u[(l < (self.num_atoms - 1)) * (l == u)] += 1
-
-            # Distribute probability of Tz
-            m = torch.zeros((self.cfg.batch_size, self.num_atoms), device=self.device)
-            for idx in range(self.cfg.batch_size):
-                # += operation do not allow to add value to same index multiple times
-                m[idx].index_add_(0, l[idx], target_q_dist[idx] * (u[idx] - b[idx]))
-                m[idx].index_add_(0, u[idx], target_q_dist[idx] * (b[idx] - l[idx]))
-            
-        # kl_div: m * torch.log(m) - log_pred_q_dist
-                
         # kl-divergence 
-        kl_div = -torch.sum(m * log_pred_q_dist, -1)
-        loss = (kl_div * weights).mean()
+        kl_div, loss = c51_loss(log_pred_q_dist, m, weights)
         
         # update priority
-        if self.buffer.name == 'per_buffer':
-            self.buffer.update_priorities(idxs=idxs, priorities=kl_div.detach().cpu().numpy())
+        update_priorities(self.buffer, idxs, kl_div)
 
         # logs
         log_data = {
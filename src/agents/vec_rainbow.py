@@ -0,0 +1,275 @@
+from src.common.train_utils import autocast
+from .base import build_optimizer
+from .rainbow import gather_action, greedy_target_dist, project_target_dist, c51_loss, update_priorities
+from torch.func import stack_module_state, functional_call, vmap
+from einops import rearrange
+import torch
+import numpy as np
+import random
+import tqdm
+import copy
+import itertools
+
+
+class VecRAINBOW():
+    name = 'vec_rainbow'
+    def __init__(self,
+                 cfg,
+                 device,
+                 train_envs,
+                 eval_envs,
+                 logger,
+                 buffers,
+                 aug_func,
+                 models):
+        """
+        K independent RAINBOW agents (seeds) trained in lock-step within a single process.
+        Each seed has its own env, replay buffer and parameters. The parameters of the K models are
+        stacked along a leading seed dim and every forward is vmapped over it, so action selection
+        and learner updates run as one batched computation.
+        """
+        self.cfg = cfg
+        self.device = device
+        self.num_seeds = len(models)
+        self.train_envs = train_envs
+        self.eval_envs = eval_envs
+        self.logger = logger
+        self.buffers = buffers
+        self.aug_func = aug_func.to(self.device)
+        self.models = [model.to(self.device) for model in models]
+
+        if self.cfg.finetune_type == 'freeze':
+            for model in self.models:
+                for param in model.backbone.parameters():
+                    param.requires_grad = False
+
+        # stacked parameters / buffers: (k, ...), the module skeleton holds no data
+        self.params, self.model_buffers = stack_module_state(self.models)
+        self.target_params = {k: v.detach().clone() for k, v in self.params.items()}
+        self.target_buffers = {k: v.clone() for k, v in self.model_buffers.items()}
+        self.base_model = copy.deepcopy(self.models[0]).to('meta')
+
+        # adam / rmsprop are element-wise: one optimizer over the stacked parameters
+        # keeps an independent optimizer state for every seed
+        param_group = [param for param in self.params.values() if param.requires_grad]
+        self.optimizer = build_optimizer(param_group, cfg.optimizer)
+
+        # distributional
+        self.num_atoms = self.models[0].policy.get_num_atoms()
+        self.v_min = self.cfg.v_min
+        self.v_max = self.cfg.v_max
+        self.support = torch.linspace(self.v_min, self.v_max, self.num_atoms).to(self.device)
+
+    @classmethod
+    def get_name(cls):
+        return cls.name
+
+    def _forward(self, params, buffers, obs, mode, backbone_mode):
+        """
+        [params] obs: (k, n, t, f, c, h, w)
+        [returns] q_dist, log_q_dist: (k, n, a, num_atoms)
+        """
+        self.base_model.train(mode == 'train')
+        if backbone_mode == 'eval':
+            self.base_model.backbone.eval()
+
+        def forward(params, buffers, obs):
+            q_dist, info = functional_call(self.base_model, (params, buffers), (obs,))
+            return q_dist, info['policy']['log']
+
+        return vmap(forward)(params, buffers, obs)
+
+    def _reset_noise(self, buffers):
+        # factorised noise f(x) = sgn(x)√|x| of the stacked NoisyLinear buffers
+        for name, buffer in buffers.items():
+            if name.startswith('policy.') and 'epsilon' in name:
+                x = torch.randn_like(buffer)
+                buffer.copy_(x.sign().mul_(x.abs().sqrt_()))
+
+    def _clip_grad_norm(self, max_norm):
+        # per-seed total norm, identical to clip_grad_norm_ on each model
+        grads = [param.grad for param in self.optimizer.param_groups[0]['params'] if param.grad is not None]
+        norms = torch.stack([grad.flatten(1).norm(2, dim=1) for grad in grads], 1).norm(2, dim=1)
+        clip_coef = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+        for grad in grads:
+            grad.mul_(clip_coef.view(-1, *([1] * (grad.dim() - 1))))
+
+    @torch.no_grad()
+    def unstack_models(self):
+        """
+        Copies the current stacked parameters / buffers back into the per-seed models.
+        [returns] models: list of the k models
+        """
+        for k, model in enumerate(self.models):
+            for name, tensor in itertools.chain(model.named_parameters(), model.named_buffers()):
+                stacked = self.params[name] if name in self.params else self.model_buffers[name]
+                tensor.copy_(stacked[k])
+        return self.models
+
+    def encode_obs(self, obs):
+        """
+        [params] obs: list of k observations
+        [returns] obs: (k, 1, 1, f, c, h, w)
+        """
+        return torch.stack([buffer.encode_obs(o, prediction=True)
+                            for buffer, o in zip(self.buffers, obs)])
+
+    def predict(self, obs, mode):
+        if mode == 'train':
+            q_dist, _ = self._forward(self.params, self.model_buffers, obs, 'train', self.cfg.eval_backbone_mode)
+        elif mode == 'eval':
+            q_dist, _ = self._forward(self.params, self.model_buffers, obs, 'eval', 'eval')
+        q_value = (q_dist * self.support.reshape(1,1,1,-1)).sum(-1)
+        argmax_actions = torch.argmax(q_value, -1)[:, 0].tolist()
+
+        actions = []
+        for argmax_action in argmax_actions:
+            if mode == 'eval' and random.random() < self.cfg.eval_eps:
+                actions.append(random.randint(0, self.cfg.action_size-1))
+            else:
+                actions.append(argmax_action)
+
+        return actions
+
+    def update(self):
+        for name, param in self.params.items():
+            self.target_params[name].copy_(param.detach())
+        for name, buffer in self.model_buffers.items():
+            self.target_buffers[name].copy_(buffer)
+
+    def reset(self):
+        for seed, model in enumerate(self.models):
+            model.policy.reset_parameter()
+            for name, param in model.policy.named_parameters():
+                self.params['policy.' + name].data[seed].copy_(param.data)
+        self._reset_noise(self.model_buffers)
+
+    def compute_loss(self):
+        # get samples from buffers: (k, n, ...)
+        samples = [buffer.sample(self.cfg.batch_size) for buffer in self.buffers]
+        obs_batch = torch.stack([sample['obs'] for sample in samples])
+        act_batch = torch.stack([sample['act'] for sample in samples])
+        return_batch = torch.stack([sample['return'] for sample in samples])
+        done_batch = torch.stack([sample['done'] for sample in samples])
+        next_obs_batch = torch.stack([sample['next_obs'] for sample in samples])
+        weights = torch.stack([sample['weights'] for sample in samples])
+
+        # augment the observation of all seeds at once
+        k, n, t, f, c, h, w = obs_batch.shape
+        obs_batch = rearrange(obs_batch, 'k n t f c h w -> (k n) (t f c) h w')
+        next_obs_batch = rearrange(next_obs_batch, 'k n t f c h w -> (k n) (t f c) h w')
+        obs_batch, next_obs_batch = self.aug_func([obs_batch, next_obs_batch]).chunk(2)
+        obs_batch = rearrange(obs_batch, '(k n) (t f c) h w -> k n t f c h w', k=k, t=t, f=f, c=c)
+        next_obs_batch = rearrange(next_obs_batch, '(k n) (t f c) h w -> k n t f c h w', k=k, t=t, f=f, c=c)
+
+        # reset noise
+        self._reset_noise(self.model_buffers)
+        self._reset_noise(self.target_buffers)
+
+        # Calculate current state's q-value distribution
+        # cur_online_log_q_dist: (K, N, A, N_A = num_atoms)
+        # log_pred_q_dist: (K, N, N_A)
+        _, cur_online_log_q_dist = self._forward(self.params, self.model_buffers, obs_batch,
+                                                 'train', self.cfg.train_backbone_mode)
+        log_pred_q_dist = gather_action(cur_online_log_q_dist, act_batch)
+
+        with torch.no_grad():
+            # Calculate n-th next state's q-value distribution
+            # next_target_q_dist: (k, n, a, num_atoms)
+            # target_q_dist: (k, n, num_atoms)
+            next_target_q_dist, _ = self._forward(self.target_params, self.target_buffers, next_obs_batch,
+                                                  'train', self.cfg.train_target_backbone_mode)
+            if self.cfg.double:
+                next_online_q_dist, _ = self._forward(self.params, self.model_buffers, next_obs_batch,
+                                                      'train', self.cfg.train_backbone_mode)
+                target_q_dist = greedy_target_dist(next_target_q_dist, next_online_q_dist, self.support)
+            else:
+                target_q_dist = greedy_target_dist(next_target_q_dist, next_target_q_dist, self.support)
+            m = project_target_dist(target_q_dist, return_batch, done_batch,
+                                    self.support, self.cfg.gamma, self.buffers[0].n_step)
+
+        # kl-divergence, each seed's loss only depends on its own parameters
+        kl_div, seed_losses = c51_loss(log_pred_q_dist, m, weights)
+        loss = seed_losses.sum()
+
+        # update priority
+        for buffer, sample, seed_kl_div in zip(self.buffers, samples, kl_div):
+            update_priorities(buffer, sample['idxs'], seed_kl_div)
+
+        # logs
+        log_data = [{'loss': seed_loss} for seed_loss in seed_losses.detach().tolist()]
+        return loss, log_data
+
+    def train(self):
+        obs = [env.reset() for env in self.train_envs]
+        for t in tqdm.tqdm(range(1, self.cfg.num_timesteps+1)):
+            # act
+            if t < self.cfg.min_buffer_size:
+                actions = [random.randint(0, self.cfg.action_size - 1) for _ in range(self.num_seeds)]
+            else:
+                with torch.no_grad():
+                    actions = self.predict(self.encode_obs(obs), mode='train')
+
+            for seed in range(self.num_seeds):
+                next_obs, reward, done, info = self.train_envs[seed].step(actions[seed])
+
+                # store new transition
+                self.buffers[seed].store(obs[seed], actions[seed], reward, done, next_obs)
+                self.logger.step(obs[seed], reward, done, info, mode='train', seed=seed)
+
+                # reset environment when trajectory is done
+                if info.traj_done:
+                    obs[seed] = self.train_envs[seed].reset()
+                else:
+                    obs[seed] = next_obs
+
+            # optimize
+            if (t >= self.cfg.min_buffer_size) & (t % self.cfg.optimize_freq == 0):
+                for _ in range(self.cfg.optimize_per_step):
+                    self.optimizer.zero_grad()
+                    with autocast(self.device, self.cfg.autocast):
+                        loss, log_data = self.compute_loss()
+                    loss.backward()
+                    self._clip_grad_norm(self.cfg.clip_grad_norm)
+                    self.optimizer.step()
+                    for seed in range(self.num_seeds):
+                        self.logger.update_log(mode='train', seed=seed, **log_data[seed])
+
+            # evaluate
+            if t % self.cfg.eval_every == 0:
+                self.evaluate()
+
+            # log
+            if t % self.cfg.log_every == 0:
+                self.logger.write_log(mode='train')
+
+            # reset model
+            if (t >= self.cfg.min_buffer_size) & (t % self.cfg.reset_freq == 0):
+                self.reset()
+
+            # update
+            if (t >= self.cfg.min_buffer_size) & (t % self.cfg.update_freq == 0):
+                self.update()
+
+    def evaluate(self):
+        num_trajectories = np.zeros(self.num_seeds, dtype=np.int64)
+        obs = [env.reset() for env in self.eval_envs]
+        while num_trajectories.min() < self.cfg.num_eval_trajectories:
+            # evaluation is based on greedy prediction
+            with torch.no_grad():
+                actions = self.predict(self.encode_obs(obs), mode='eval')
+
+            for seed in range(self.num_seeds):
+                if num_trajectories[seed] >= self.cfg.num_eval_trajectories:
+                    continue
+                next_obs, reward, done, info = self.eval_envs[seed].step(actions[seed])
+                self.logger.step(obs[seed], reward, done, info, mode='eval', seed=seed)
+
+                # move on
+                if info.traj_done:
+                    num_trajectories[seed] += 1
+                    obs[seed] = self.eval_envs[seed].reset()
+                else:
+                    obs[seed] = next_obs
+
+        self.logger.write_log(mode='eval')
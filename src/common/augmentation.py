@@ -17,12 +17,79 @@ class Intensity(nn.Module):
         return x * noise
 
 
+def to_float(x):
+    # uint8 observations are normalized to [0, 1]
+    if x.dtype == torch.uint8:
+        x = x.float().div_(255.0)
+    return x
+
+
+def random_shift_index(n, h, w, pad, device, shift=None):
+    """
+    Flat (h*w) gather index of a random integer crop from a replicate-padded image,
+    equivalent to ReplicationPad2d(pad) followed by a random (h, w) crop.
+    [params] shift: (n, 2) integer (row, col) offsets in [0, 2*pad], sampled if None
+    [returns] index: (n, 1, h*w)
+    """
+    if shift is None:
+        shift = torch.randint(0, 2 * pad + 1, size=(n, 2), device=device)
+    rows = (torch.arange(h, device=device).unsqueeze(0) + shift[:, :1] - pad).clamp_(0, h-1)
+    cols = (torch.arange(w, device=device).unsqueeze(0) + shift[:, 1:] - pad).clamp_(0, w-1)
+    index = rows.unsqueeze(2) * w + cols.unsqueeze(1)
+    return index.view(n, 1, h * w)
+
+
+class RandomShiftIntensity(nn.Module):
+    def __init__(self, pad, scale):
+        """
+        Fused random_shift + intensity.
+        Shifts every sample with a single gather on the (uint8) input and applies
+        intensity noise and [0, 255] -> [0, 1] normalization as one multiply.
+        """
+        super().__init__()
+        self.pad = pad
+        self.scale = scale
+
+    def forward(self, x, num_views=1):
+        """
+        [params] x: (n, c, h, w) tensor or list of m such tensors
+        [returns] x: (num_views*m*n, c, h, w) independently augmented views,
+                     ordered as [view_1(x_1), ..., view_1(x_m), view_2(x_1), ...]
+        """
+        xs = [x] if torch.is_tensor(x) else list(x)
+        n, c, h, w = xs[0].shape
+        num_blocks = num_views * len(xs)
+        index = random_shift_index(num_blocks * n, h, w, self.pad, xs[0].device)
+        index = index.expand(num_blocks * n, c, h * w)
+        
+        # gather every view straight into one preallocated batch
+        x = torch.empty((num_blocks * n, c, h * w), dtype=xs[0].dtype, device=xs[0].device)
+        for block in range(num_blocks):
+            sl = slice(block * n, (block + 1) * n)
+            source = xs[block % len(xs)].reshape(n, c, h * w)
+            torch.gather(source, 2, index[sl], out=x[sl])
+        
+        r = torch.randn((num_blocks * n, 1, 1), device=x.device)
+        noise = 1.0 + (self.scale * r.clamp(-2.0, 2.0))
+        if x.dtype == torch.uint8:
+            x = torch.mul(x, noise / 255.0)
+        else:
+            x = x.mul_(noise)
+        return x.view(num_blocks * n, c, h, w)
+
+
 class Augmentation(nn.Module):
     def __init__(self, obs_shape, aug_types=[]):
         super().__init__()
         self.layers = []
-        for aug_type in aug_types:
-            if aug_type == 'random_shift':
+        aug_types = list(aug_types)
+        while len(aug_types) > 0:
+            aug_type = aug_types.pop(0)
+            if aug_type == 'random_shift' and len(aug_types) > 0 and aug_types[0] == 'intensity':
+                aug_types.pop(0)
+                self.layers.append(RandomShiftIntensity(pad=4, scale=0.05))
+            
+            elif aug_type == 'random_shift':
                 _, _, W, H = obs_shape
                 self.layers.append(nn.ReplicationPad2d(4))
                 self.layers.append(aug.RandomCrop((W, H)))
@@ -47,10 +114,29 @@ class Augmentation(nn.Module):
 
         self.layers = nn.ModuleList(self.layers)
 
-    def forward(self, x):
-        for layer in self.layers:
+    def forward(self, x, num_views=1):
+        """
+        [params] x: (n, c, h, w) float in [0, 1] or uint8 in [0, 255], or a list of m such tensors
+        [params] num_views: number of independently augmented views of each input
+        [returns] x: (num_views*m*n, c, h, w) float in [0, 1],
+                     ordered as [view_1(x_1), ..., view_1(x_m), view_2(x_1), ...]
+        """
+        xs = [x] if torch.is_tensor(x) else list(x)
+        layers = list(self.layers)
+        
+        # every augmentation samples its parameters per-sample, so all views can share one pass
+        if len(layers) > 0 and isinstance(layers[0], RandomShiftIntensity):
+            x = layers.pop(0)(xs, num_views=num_views)
+        elif num_views * len(xs) > 1:
+            x = torch.cat(xs * num_views)
+        else:
+            x = xs[0]
+        
+        for layer in layers:
+            if not isinstance(layer, RandomShiftIntensity):
+                x = to_float(x)
             x = layer(x)
-        return x
+        return to_float(x)
 
 
 #####################
@@ -61,6 +147,31 @@ class RandomShiftsAug(nn.Module):
         self.pad = pad
 
     def forward(self, x):
+        n, c, h, w = x.size()
+        shift = torch.randint(0,
+                              2 * self.pad + 1,
+                              size=(n, 2),
+                              device=x.device)
+        
+        # whole-pixel shifts are an integer crop of the padded image
+        if isinstance(self.pad, int):
+            return self.shift_by_gather(x, shift)
+        else:
+            return self.shift_by_grid_sample(x, shift)
+
+    def shift_by_gather(self, x, shift):
+        """
+        [params] shift: (n, 2) integer (x, y) offsets in [0, 2*pad]
+        """
+        n, c, h, w = x.size()
+        index = random_shift_index(n, h, w, self.pad, x.device, shift=shift.flip(1))
+        x = torch.gather(x.reshape(n, c, h * w), 2, index.expand(n, c, h * w))
+        return x.view(n, c, h, w)
+
+    def shift_by_grid_sample(self, x, shift):
+        """
+        [params] shift: (n, 2) integer (x, y) offsets in [0, 2*pad]
+        """
         n, c, h, w = x.size()
         assert h == w
         padding = tuple([self.pad] * 4)
@@ -75,11 +186,7 @@ class RandomShiftsAug(nn.Module):
         base_grid = torch.cat([arange, arange.transpose(1, 0)], dim=2)
         base_grid = base_grid.unsqueeze(0).repeat(n, 1, 1, 1)
 
-        shift = torch.randint(0,
-                              2 * self.pad + 1,
-                              size=(n, 1, 1, 2),
-                              device=x.device,
-                              dtype=x.dtype)
+        shift = shift.view(n, 1, 1, 2).to(x.dtype)
         shift *= 2.0 / (h + 2 * self.pad)
 
         grid = base_grid + shift
@@ -87,4 +194,3 @@ class RandomShiftsAug(nn.Module):
                              grid,
                              padding_mode='zeros',
                              align_corners=False)
-
@@ -1,3 +1,8 @@
+import os
+import tqdm
+import random
+import threading
+from collections import deque
 import torch
 import numpy as np
 from src.common.class_utils import namedarraytuple
@@ -45,66 +50,196 @@ class CacheEfficientSampler(torch.utils.data.Sampler):
         return self.num_samples()
 
     
-def grouper(iterable, n, fillvalue=None):
-    "Collect data into fixed-length chunks or blocks"
-    # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx"
-    args = [iter(iterable)] * n
-    return zip_longest(*args, fillvalue=fillvalue)
-
-
-def shuffle_batch_dim(observations,
-                      rewards,
-                      actions,
-                      dones,
-                      obs_on_disk=True,
-                      chunk_num=1):
+class ResidencyManager():
+    def __init__(self, datasets, num_resident, seed=0):
+        """
+        Keeps a fixed number of checkpoint blocks (ReplayDataset) fully loaded in RAM.
+        The next block of the schedule is read in a background thread and swapped in by rotate(),
+        so the memory budget is (num_resident + 1) blocks.
+        [params] datasets: list of ReplayDataset with memmapped observations (dataset_on_disk=True)
+        [params] num_resident: number of blocks to keep in RAM
+        """
+        self.datasets = datasets
+        self.num_blocks = len(datasets)
+        self.num_resident = min(num_resident, self.num_blocks)
+        self.mmaps = [dataset.observation for dataset in datasets]
+        self.random_state = np.random.RandomState(seed)
+        self.schedule = deque()
+        self.resident = deque()
+        self.staging = None
+
+        for _ in range(self.num_resident):
+            block = self._next_block()
+            self.datasets[block].observation = self._read(block)
+            self.resident.append(block)
+        self._prefetch()
+
+    def _next_block(self):
+        # cycle through random permutations of the non-resident blocks
+        while True:
+            if len(self.schedule) == 0:
+                self.schedule.extend(self.random_state.permutation(self.num_blocks))
+            block = self.schedule.popleft()
+            if block not in self.resident:
+                return block
+
+    def _read(self, block):
+        return np.array(self.mmaps[block])
+
+    def _prefetch(self):
+        if self.num_resident == self.num_blocks:
+            return
+        block = self._next_block()
+        holder = {}
+        def load():
+            holder['observation'] = self._read(block)
+        thread = threading.Thread(target=load, daemon=True)
+        thread.start()
+        self.staging = (block, thread, holder)
+
+    def rotate(self):
+        """
+        Swap the oldest resident block with the prefetched one.
+        Blocks only if the background read has not finished yet.
+        """
+        if self.staging is None:
+            return
+        block, thread, holder = self.staging
+        thread.join()
+        evicted = self.resident.popleft()
+        self.datasets[evicted].observation = self.mmaps[evicted]
+        self.datasets[block].observation = holder['observation']
+        self.resident.append(block)
+        self._prefetch()
+
+
+class ResidentBlockSampler(torch.utils.data.Sampler):
+    def __init__(self, manager, block_len, rotate_every, resident_ratio=1.0, generator=None):
+        """
+        Draws (1-resident_ratio) of the samples over all blocks and the rest from
+        the blocks currently resident in RAM, rotating the residency every rotate_every samples.
+        The samples of each rotation are spread evenly over the blocks, and the time indices of
+        each block follow a per-epoch permutation, so no window repeats before its block is covered.
+        Indices follow the MultiReplayDataset layout (index = time_idx * num_blocks + block).
+        Requires num_workers=0, since the manager lives in the sampling process.
+        """
+        self.manager = manager
+        self.num_blocks = manager.num_blocks
+        self.block_len = block_len
+        self.rotate_every = rotate_every
+        self.resident_ratio = resident_ratio
+        self.generator = generator
+
+    def num_samples(self) -> int:
+        return self.block_len * self.num_blocks
+
+    def _spread(self, blocks, size, generator):
+        # size draws of blocks, each block used floor or ceil(size / len(blocks)) times
+        if size == 0:
+            return blocks[:0]
+        blocks = blocks[torch.randperm(len(blocks), generator=generator)]
+        num_repeats = -(-size // len(blocks))
+        return blocks.repeat(num_repeats)[:size]
+
+    def __iter__(self):
+        if self.generator is None:
+            generator = torch.Generator()
+            generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+        else:
+            generator = self.generator
+
+        # per-block permutation of the time indices, re-drawn once a block is exhausted
+        orders = [torch.randperm(self.block_len, generator=generator) for _ in range(self.num_blocks)]
+        cursors = [0] * self.num_blocks
+        def take(block, count):
+            time_idxs = []
+            while count > 0:
+                if cursors[block] == self.block_len:
+                    orders[block] = torch.randperm(self.block_len, generator=generator)
+                    cursors[block] = 0
+                num = min(count, self.block_len - cursors[block])
+                time_idxs.append(orders[block][cursors[block]:cursors[block] + num])
+                cursors[block] += num
+                count -= num
+            return torch.cat(time_idxs)
+
+        n = self.num_samples()
+        for start in range(0, n, self.rotate_every):
+            if start > 0:
+                self.manager.rotate()
+            size = min(self.rotate_every, n - start)
+            resident = torch.LongTensor(list(self.manager.resident))
+            
+            # blocks: resident blocks for resident_ratio of the samples, any block otherwise
+            num_resident = int(round(size * self.resident_ratio))
+            blocks = torch.cat([self._spread(resident, num_resident, generator),
+                                self._spread(torch.arange(self.num_blocks), size - num_resident, generator)])
+            blocks = blocks[torch.randperm(size, generator=generator)]
+            time_idxs = torch.empty(size, dtype=torch.long)
+            for block in blocks.unique().tolist():
+                mask = (blocks == block)
+                time_idxs[mask] = take(block, int(mask.sum()))
+            
+            yield from (time_idxs * self.num_blocks + blocks).tolist()
+
+    def __len__(self):
+        return self.num_samples()
+
+
+def relayout_replay_dataset(dataset, relayout_path, block_size=256, seed=0):
+    """
+    Write a pre-shuffled copy of every (t+f-1)-frame window of the dataset so that
+    an epoch can be streamed with large sequential reads instead of random memmap reads.
+    Windows of all checkpoints are shuffled together; each window is stored frame-stack
+    ready (same format as ReplayDataset.__getitem__).
+    [params] dataset: MultiReplayDataset
+    [params] relayout_path: directory to store {filetype}.npy
+    [params] block_size: number of windows gathered in memory before each write
+    """
+    os.makedirs(relayout_path, exist_ok=True)
+    filetypes = ['observation', 'action', 'reward', 'terminal', 'rtg']
+    num_windows = len(dataset)
+    order = np.random.RandomState(seed).permutation(num_windows)
+
+    # allocate output files from the first window
+    sample = [x.cpu().numpy() for x in dataset[0]]
+    files = {}
+    for filetype, x in zip(filetypes, sample):
+        filename = os.path.join(relayout_path, filetype + '.npy')
+        files[filetype] = np.lib.format.open_memmap(filename, mode='w+', dtype=x.dtype,
+                                                    shape=(num_windows, *x.shape))
+    
+    for start in tqdm.tqdm(range(0, num_windows, block_size)):
+        idxs = order[start:start+block_size]
+        blocks = [np.empty((len(idxs), *x.shape), dtype=x.dtype) for x in sample]
+        
+        # read windows in (checkpoint, time) order to keep source reads local
+        ckpt_idxs = idxs % dataset.num_blocks
+        time_idxs = idxs // dataset.num_blocks
+        for pos in np.lexsort((time_idxs, ckpt_idxs)):
+            window = dataset[idxs[pos]]
+            for block, x in zip(blocks, window):
+                block[pos] = x.cpu().numpy()
+        
+        # single contiguous write per filetype
+        for filetype, block in zip(filetypes, blocks):
+            files[filetype][start:start+len(idxs)] = block
+    
+    for filetype in filetypes:
+        files[filetype].flush()
+        print("Stored relayout on disk at {}".format(files[filetype].filename))
+    del files
+
+
+def seed_worker(worker_id):
     """
-    :param observations: (T, B, *) obs tensor, optionally mmap
-    :param rewards: (T, B) rewards tensor
-    :param actions: (T, B, *) actions tensor
-    :param dones: (T, B) termination tensor
-    :param obs_on_disk: Store observations on disk.  Generally true if using
-    more than ~3M transitions
-    :return:
+    DataLoader worker_init_fn: torch is already seeded with (base_seed + worker_id),
+    propagate it to numpy / random and keep workers single-threaded.
     """
-    batch_dim = observations[0].shape[1]
-    num_sources = len(observations)
-    batch_allocations = [np.sort((np.arange(batch_dim) + i) % num_sources) for i in range(num_sources)]
-
-    shuffled_observations, shuffled_rewards, shuffled_actions, shuffled_dones = [], [], [], []
-
-    checkpoints = list(range(num_sources))
-    for sources, shuffled, filetype in zip([observations, rewards, actions, dones],
-                                           [shuffled_observations, shuffled_rewards, shuffled_actions, shuffled_dones],
-                                           ["observations", "rewards", "actions", "dones"]):
-        ind_counters = [0]*num_sources
-
-        for start in checkpoints[::chunk_num]:
-            chunk = checkpoints[start:start+chunk_num]
-            chunk_arrays = []
-            for i in chunk:
-                if isinstance(sources[0], torch.Tensor):
-                    new_array = torch.zeros_like(sources[0])
-                else:
-                    new_array = np.zeros(sources[0].shape, dtype=sources[0].dtype)
-                chunk_arrays.append(new_array)
-            for source, allocation in zip(sources, batch_allocations):
-                print(chunk, ind_counters)
-                for i, new_array in zip(chunk, chunk_arrays):
-                    mapped_to_us = [b for b, dest in enumerate(allocation) if dest == i]
-                    new_array[:, ind_counters[i]:ind_counters[i]+len(mapped_to_us)] = source[:, mapped_to_us[0]:mapped_to_us[-1]+1]
-                    ind_counters[i] += len(mapped_to_us)
-
-            for i, new_array in zip(chunk, chunk_arrays):
-                if filetype in ["observations"] and obs_on_disk:
-                    filename = observations[i].filename.replace(".npy", "_shuffled.npy")
-                    print("Stored shuffled obs on disk at {}".format(filename))
-                    np.save(filename, new_array)
-                    del new_array
-                    new_array = np.load(filename, mmap_mode="r+")
-                shuffled.append(new_array)
-
-    return shuffled_observations, shuffled_rewards, shuffled_actions, shuffled_dones
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+    torch.set_num_threads(1)
 
 
 def sanitize_batch(batch: OfflineSamples) -> OfflineSamples:
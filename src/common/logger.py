@@ -71,36 +71,56 @@ class WandbAgentLogger(object):
                    reinit=True,
                    settings=wandb.Settings(start_method="thread"))    
 
-        self.train_logger = AgentLogger(average_len=10)
-        self.eval_logger = AgentLogger(average_len=100)
+        # one logger per seed when several seeds are trained in the same process
+        self.num_seeds = cfg.num_seeds
+        self.train_loggers = [AgentLogger(average_len=10) for _ in range(self.num_seeds)]
+        self.eval_loggers = [AgentLogger(average_len=100) for _ in range(self.num_seeds)]
         self.timestep = 0
     
-    def step(self, state, reward, done, info, mode='train'):
+    def step(self, state, reward, done, info, mode='train', seed=0):
         if mode == 'train':
-            self.train_logger.step(state, reward, done, info)
-            self.timestep += 1
+            self.train_loggers[seed].step(state, reward, done, info)
+            if seed == 0:
+                self.timestep += 1
 
         elif mode == 'eval':
-            self.eval_logger.step(state, reward, done, info)
+            self.eval_loggers[seed].step(state, reward, done, info)
 
-    def update_log(self, mode='train', **kwargs):
+    def update_log(self, mode='train', seed=0, **kwargs):
         if mode == 'train':
-            self.train_logger.update_log(**kwargs)
+            self.train_loggers[seed].update_log(**kwargs)
 
         elif mode == 'eval':
-            self.eval_logger.update_log(**kwargs)
+            self.eval_loggers[seed].update_log(**kwargs)
     
     def write_log(self, mode='train'):
         if mode == 'train':
-            log_data = self.train_logger.fetch_log()
+            seed_logs = [logger.fetch_log() for logger in self.train_loggers]
 
         elif mode == 'eval':
-            log_data = self.eval_logger.fetch_log()
+            seed_logs = [logger.fetch_log() for logger in self.eval_loggers]
+
+        # multiple seeds: mean over seeds and per-seed values
+        log_data = seed_logs[0]
+        if self.num_seeds > 1:
+            log_data = {k: np.mean([seed_log[k] for seed_log in seed_logs]) for k in seed_logs[0]}
+            for seed, seed_log in enumerate(seed_logs):
+                log_data.update({'seed' + str(seed) + '_' + k: v for k, v in seed_log.items()})
 
         # prefix
         log_data = {mode+'_'+k: v for k, v in log_data.items() }
         wandb.log(log_data, step=self.timestep)
 
+    def save_state_dict(self, model, name, seed=0):
+        # seed: index of the seed in a multi-seed run, saved under cfg.seed + seed
+        path = './models/' + self.cfg.exp_name + '/' + self.cfg.env.game + '/' + str(self.cfg.seed + seed) + '/'
+        path = path + str(name) + '/model.pth'
+        _dir = os.path.dirname(path)
+        if not os.path.exists(_dir):
+            os.makedirs(_dir)
+        state_dict = {'model_state_dict': model.state_dict()}
+        torch.save(state_dict, path)
+
     
 class VecAgentLogger(object):
     def __init__(self, average_len=10, num_envs=1):
@@ -107,17 +107,21 @@ class BarlowLoss(nn.Module):
         
     def forward(self, z1, z2):
         n, d = z1.shape
-        # normalize along batch dim
-        z1 = (z1 - z1.mean(0)) / z1.std(0) # NxD
-        z2 = (z2 - z2.mean(0)) / z2.std(0) # NxD
-        
-        # cross correltation matrix
-        cor = torch.mm(z1.T, z2)
-        cor.div_(n)
-        
-        # loss
-        on_diag = torch.diagonal(cor).add_(-1).pow_(2).sum()
-        off_diag = self._off_diagonal(cor).pow_(2).sum()
+        # standardization and the (d, d) cross-correlation are kept in fp32 under autocast
+        with torch.autocast(device_type=z1.device.type, enabled=False):
+            z1, z2 = z1.float(), z2.float()
+            
+            # normalize along batch dim
+            z1 = (z1 - z1.mean(0)) / z1.std(0) # NxD
+            z2 = (z2 - z2.mean(0)) / z2.std(0) # NxD
+
+            # cross correltation matrix
+            cor = torch.mm(z1.T, z2)
+            cor.div_(n)
+
+            # loss
+            on_diag = torch.diagonal(cor).add_(-1).pow_(2).sum()
+            off_diag = self._off_diagonal(cor).pow_(2).sum()
         
         loss = on_diag + self.lmbda * off_diag
         
@@ -5,6 +5,7 @@ import re
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from torch import distributions as pyd
 from torch.distributions.utils import _standard_normal
 from torch.optim.lr_scheduler import _LRScheduler
@@ -94,6 +95,48 @@ def init_normalization(channels, norm_type="bn", one_d=False):
     elif norm_type is None:
         return nn.Identity()
 
+######################
+# mixed precision
+def autocast(device, enabled):
+    """
+    bfloat16 autocast on cpu / cuda: keeps the fp32 exponent range, so no loss scaling is needed.
+    """
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=enabled)
+
+######################
+# activation checkpointing
+def checkpoint_forward(module, fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) without storing intermediate activations, 
+    they are recomputed during backward.
+    BatchNorm layers of the module only update their running statistics in the original forward,
+    the recompute uses momentum 0 and restores num_batches_tracked so each batch is counted once
+    (also for momentum=None, the cumulative average).
+    """
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    is_recompute = [False]
+    
+    def run(*args, **kwargs):
+        if not is_recompute[0]:
+            is_recompute[0] = True
+            return fn(*args, **kwargs)
+        
+        momentums = [bn.momentum for bn in bns]
+        num_batches_tracked = [None if bn.num_batches_tracked is None else bn.num_batches_tracked.clone()
+                               for bn in bns]
+        for bn in bns:
+            bn.momentum = 0.0
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            for bn, momentum, tracked in zip(bns, momentums, num_batches_tracked):
+                bn.momentum = momentum
+                if tracked is not None:
+                    bn.num_batches_tracked.copy_(tracked)
+    
+    return torch.utils.checkpoint.checkpoint(run, *args, use_reentrant=False, **kwargs)
+
+
 ######################
 # scheduler
 class LinearScheduler(object):
@@ -247,12 +290,20 @@ class ScaleGrad(torch.autograd.Function):
     """Model component to scale gradients back from layer, without affecting
     the forward pass.  Used e.g. in dueling heads DQN models."""
 
+    # setup_context style, so the function can run under torch.func.vmap
+    generate_vmap_rule = True
+
+    @staticmethod
+    def forward(tensor, scale):
+        """Simply returns (a copy of) the input ``tensor``."""
+        return tensor.clone()
+
     @staticmethod
-    def forward(ctx, tensor, scale):
+    def setup_context(ctx, inputs, output):
         """Stores the ``scale`` input to ``ctx`` for application in
-        ``backward()``; simply returns the input ``tensor``."""
+        ``backward()``."""
+        _, scale = inputs
         ctx.scale = scale
-        return tensor
 
     @staticmethod
     def backward(ctx, grad_output):
@@ -6,7 +6,7 @@ import_all_subclasses(__file__, __name__, BaseLoader)
 LOADERS = {subclass.get_name():subclass
           for subclass in all_subclasses(BaseLoader)}
 
-def build_dataloader(cfg):
+def build_loader_cfgs(cfg):
     cfg = OmegaConf.to_container(cfg)
     loader_type = cfg.pop('type')
     loader = LOADERS[loader_type]
@@ -18,9 +18,19 @@ def build_dataloader(cfg):
     train_cfg.update(cfg)
     eval_act_cfg.update(cfg)
     eval_rew_cfg.update(cfg)
+    
+    # probing loaders always return raw observations
+    eval_act_cfg['worker_aug'] = False
+    eval_rew_cfg['worker_aug'] = False
+    
+    return loader, train_cfg, eval_act_cfg, eval_rew_cfg
+
+
+def build_dataloader(cfg):
+    loader, train_cfg, eval_act_cfg, eval_rew_cfg = build_loader_cfgs(cfg)
 
     train_loader = loader(**train_cfg).get_dataloader()
     eval_act_loader = loader(**eval_act_cfg).get_dataloader()
     eval_rew_loader = loader(**eval_rew_cfg).get_dataloader()
     
-    return train_loader, eval_act_loader, eval_rew_loader
\ No newline at end of file
+    return train_loader, eval_act_loader, eval_rew_loader
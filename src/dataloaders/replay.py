@@ -7,10 +7,11 @@ from typing import List, Tuple
 import tqdm
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
 import torchvision.transforms as T
 from .base import BaseLoader
 from src.envs.atari import AtariEnv
+from src.common.augmentation import Augmentation
 from src.common.data_utils import *
 from einops import rearrange
 
@@ -233,6 +234,75 @@ class MultiReplayDataset(Dataset):
         return self.datasets[ckpt_index][index]
 
 
+class SequentialReplayDataset(IterableDataset):
+    def __init__(self,
+                 relayout_path: Path,
+                 block_size: int,
+                 shuffle: bool,
+                 read_buffer_size: int) -> None:
+        """
+        Streams windows written by relayout_replay_dataset.
+        Each worker owns a contiguous range of blocks and reads them with one large read per block,
+        block order and intra-block order are re-shuffled every epoch.
+        """
+        filename = os.path.join(relayout_path, 'observation.npy')
+        print(f'Loading {filename}')
+        observation = np.load(filename, mmap_mode='r')
+        self.obs_filename = filename
+        self.obs_offset = observation.offset
+        self.obs_shape = observation.shape[1:]
+        self.obs_dtype = observation.dtype
+        self.size = observation.shape[0]
+        del observation
+        
+        # action, reward, terminal and rtg are small enough to live in memory
+        for filetype in ['action', 'reward', 'terminal', 'rtg']:
+            data_ = np.load(os.path.join(relayout_path, filetype + '.npy'))
+            setattr(self, filetype, torch.from_numpy(data_))
+        
+        self.block_size = block_size
+        self.shuffle = shuffle
+        self.read_buffer_size = read_buffer_size
+        self.num_blocks = (self.size + block_size - 1) // block_size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _read_block(self, f, block_idx):
+        start = block_idx * self.block_size
+        end = min(start + self.block_size, self.size)
+        obs = np.empty((end - start, *self.obs_shape), dtype=self.obs_dtype)
+        f.seek(self.obs_offset + start * obs[0].nbytes)
+        f.readinto(obs.reshape(-1).view(np.uint8))
+        return start, torch.from_numpy(obs)
+
+    def __iter__(self):
+        # split blocks into contiguous per-worker ranges
+        worker_info = get_worker_info()
+        blocks = np.arange(self.num_blocks)
+        if worker_info is not None:
+            blocks = np.array_split(blocks, worker_info.num_workers)[worker_info.id]
+            
+        generator = torch.Generator()
+        generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+        if self.shuffle:
+            blocks = blocks[torch.randperm(len(blocks), generator=generator).numpy()]
+        
+        with open(self.obs_filename, 'rb', buffering=self.read_buffer_size) as f:
+            for block_idx in blocks:
+                start, obs = self._read_block(f, block_idx)
+                if self.shuffle:
+                    intra_order = torch.randperm(len(obs), generator=generator).tolist()
+                else:
+                    intra_order = range(len(obs))
+                for idx in intra_order:
+                    yield tuple([obs[idx],
+                                 self.action[start+idx],
+                                 self.reward[start+idx],
+                                 self.terminal[start+idx],
+                                 self.rtg[start+idx]])
+
+
 class ReplayDataLoader(BaseLoader):
     name = 'replay'
     def __init__(self,
@@ -254,7 +324,16 @@ class ReplayDataLoader(BaseLoader):
                  prefetch_factor: int,
                  device: str,
                  shuffle_checkpoints: bool,
-                 shuffle: bool):
+                 shuffle: bool,
+                 layout: str,
+                 relayout_block_size: int,
+                 read_buffer_size: int,
+                 num_resident_blocks: int,
+                 rotate_every: int,
+                 resident_ratio: float,
+                 worker_aug: bool,
+                 aug_types: List[str],
+                 num_views: int):
         
         super().__init__()
         self.data_type = data_type
@@ -276,14 +355,75 @@ class ReplayDataLoader(BaseLoader):
         self.device = device
         self.shuffle_checkpoints = shuffle_checkpoints
         self.shuffle = shuffle
+        self.layout = layout
+        self.relayout_block_size = relayout_block_size
+        self.read_buffer_size = read_buffer_size
+        self.num_resident_blocks = num_resident_blocks
+        self.rotate_every = rotate_every
+        self.resident_ratio = resident_ratio
+        self.worker_aug = worker_aug
+        self.aug_types = aug_types
+        self.num_views = num_views
+        # the trainers pair the views of each sample as (view 1, view 2)
+        if worker_aug and num_views != 2:
+            raise ValueError('worker_aug requires num_views: 2, got num_views: ' + str(num_views))
+        
+    @property
+    def relayout_path(self):
+        runs = '_'.join(map(str, self.runs))
+        checkpoints = '_'.join(map(str, self.checkpoints))
+        name = f'relayout_r{runs}_c{checkpoints}_t{self.t_step}_f{self.frame}_n{self.max_size}'
+        return os.path.join(self.tmp_data_path, self.game, name)
+        
+    def get_dataset(self):
+        if self.layout == 'random':
+            dataset = MultiReplayDataset(self.data_type,
+                                        self.data_path, 
+                                        self.tmp_data_path, 
+                                        self.game, 
+                                        self.runs,
+                                        self.checkpoints, 
+                                        self.frame,
+                                        self.t_step, 
+                                        self.max_size,
+                                        self.minimal_action_set, 
+                                        self.dataset_on_gpu, 
+                                        self.dataset_on_disk,
+                                        self.device)
+        
+        # pre-shuffled windows generated by run_relayout.py
+        elif self.layout == 'sequential':
+            dataset = SequentialReplayDataset(self.relayout_path,
+                                              self.relayout_block_size,
+                                              self.shuffle,
+                                              self.read_buffer_size)
+        else:
+            raise ValueError
+        
+        return dataset
+        
+    def get_dataloader(self, dataset=None):
+        # built lazily inside each worker from the first batch
+        aug_funcs = []
+        def augment(observation):
+            """
+            [params] observation: (n, t, f, c, h, w) uint8
+            [returns] observation: (num_views*n, t, f, c, h, w) float, views ordered view-major
+            """
+            n, t, f, c, h, w = observation.shape
+            if len(aug_funcs) == 0:
+                aug_funcs.append(Augmentation(obs_shape=(f, c, h, w), aug_types=self.aug_types))
+            x = rearrange(observation, 'n t f c h w -> n (t f c) h w')
+            x = aug_funcs[0](x, num_views=self.num_views)
+            return rearrange(x, 'n (t f c) h w -> n t f c h w', t=t, f=f)
         
-    def get_dataloader(self):
         def collate(batch):
             """
             [params] observation 
                 (atari): (n, t, h, w) 
                 (dmc): (n, t, c, h, w)
             [returns] observation: (n, t, f*c, h, w) c=1 in atari, c=3 in dmc
+                (worker_aug): (num_views*n, t, f*c, h, w) pre-augmented float views
             """
             f = self.frame
             observation, action, reward, done, rtg = torch.utils.data.dataloader.default_collate(batch)
@@ -311,29 +451,44 @@ class ReplayDataLoader(BaseLoader):
                 rtg = rtg[:, f-1:]
             
             # when done is True, func sanitize batch zeros out observation and reward
-            return sanitize_batch(OfflineSamples(observation, action, reward, done, rtg))
+            batch = sanitize_batch(OfflineSamples(observation, action, reward, done, rtg))
+            
+            # augmentation cost scales with num_workers instead of the training process
+            if self.worker_aug:
+                batch = batch._replace(observation=augment(batch.observation))
+            
+            return batch
+
+        if dataset is None:
+            dataset = self.get_dataset()
+        
+        # keep a fixed hot-set of checkpoints in RAM instead of relying on the page cache
+        sampler = None
+        if self.num_resident_blocks > 0 and self.layout == 'random' and self.shuffle:
+            # the manager swaps the resident blocks in this process, workers would keep stale copies
+            if not self.dataset_on_disk or self.num_workers > 0:
+                raise ValueError('num_resident_blocks > 0 requires dataset_on_disk: True and num_workers: 0, '
+                                 f'got dataset_on_disk: {self.dataset_on_disk}, num_workers: {self.num_workers}')
+            manager = ResidencyManager(dataset.datasets, self.num_resident_blocks)
+            sampler = ResidentBlockSampler(manager=manager,
+                                           block_len=dataset.block_len,
+                                           rotate_every=self.rotate_every,
+                                           resident_ratio=self.resident_ratio)
 
-        dataset = MultiReplayDataset(self.data_type,
-                                    self.data_path, 
-                                    self.tmp_data_path, 
-                                    self.game, 
-                                    self.runs,
-                                    self.checkpoints, 
-                                    self.frame,
-                                    self.t_step, 
-                                    self.max_size,
-                                    self.minimal_action_set, 
-                                    self.dataset_on_gpu, 
-                                    self.dataset_on_disk,
-                                    self.device)
+        # prefetch_factor is only valid with worker processes
+        worker_kwargs = {}
+        if self.num_workers > 0:
+            worker_kwargs['prefetch_factor'] = self.prefetch_factor
 
         dataloader = DataLoader(dataset, 
                                 batch_size=self.batch_size,
-                                shuffle=self.shuffle,
+                                shuffle=(self.shuffle and self.layout == 'random' and sampler is None),
+                                sampler=sampler,
                                 num_workers=self.num_workers,
                                 pin_memory=self.pin_memory,
                                 collate_fn=collate,
                                 drop_last=False,
-                                prefetch_factor=self.prefetch_factor)
+                                worker_init_fn=seed_worker,
+                                **worker_kwargs)
 
         return dataloader
@@ -6,9 +6,14 @@ from src.common.class_utils import all_subclasses
 ENVS = {subclass.get_name():subclass
         for subclass in all_subclasses(BaseEnv)}
 
-def build_env(cfg):     
+def build_env(cfg, seed=None):     
+    """
+    [params] seed: environment seed (cfg.seed + k for seed k of a multi-seed run), None keeps the env default
+    """
     cfg = OmegaConf.to_container(cfg)
     env_type = cfg.pop('type')
+    if seed is not None:
+        cfg['seed'] = seed
     if env_type == 'dmc':
         train_env = make_dmc_env(**cfg)
         eval_env = make_dmc_env(**cfg)
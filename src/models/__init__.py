@@ -17,7 +17,26 @@ POLICIES = {subclass.get_name():subclass
             for subclass in all_subclasses(BasePolicy)}
 
 
-def build_model(cfg):
+def infer_output_dim(module, x):
+    """
+    Output dim from a forward pass, for modules without an analytic output_dim.
+    Eval mode keeps the batchnorm statistics untouched by the fake input.
+    """
+    training = module.training
+    module.eval()
+    with torch.no_grad():
+        out, _ = module(x)
+    module.train(training)
+    
+    return out.shape[-1]
+
+
+def build_model(cfg, defer_backbone_init=False):
+    """
+    [params] defer_backbone_init: build the backbone on the meta device and allocate 
+             uninitialized storage on cpu, skipping its weight initialization. 
+             all backbone parameters and buffers must be loaded from a state_dict afterwards.
+    """
     cfg = OmegaConf.to_container(cfg)
     backbone_cfg = cfg['backbone']
     head_cfg = cfg['head']
@@ -29,12 +48,18 @@ def build_model(cfg):
 
     # backbone
     backbone = BACKBONES[backbone_type]
-    backbone = backbone(**backbone_cfg)
+    if defer_backbone_init:
+        with torch.device('meta'):
+            backbone = backbone(**backbone_cfg)
+        backbone = backbone.to_empty(device='cpu')
+    else:
+        backbone = backbone(**backbone_cfg)
     
     # get output dim of backbone
-    fake_obs = torch.zeros((2, 1, *backbone_cfg['obs_shape']))
-    out, _ = backbone(fake_obs)
-    output_dim = out.shape[-1]
+    output_dim = backbone.output_dim
+    if output_dim is None:
+        fake_obs = torch.zeros((1, 1, *backbone_cfg['obs_shape']))
+        output_dim = infer_output_dim(backbone, fake_obs)
     
     # head
     head_cfg['in_dim'] = output_dim
@@ -42,8 +67,10 @@ def build_model(cfg):
     head = head(**head_cfg)
     
     # get output dim of head
-    out, _ = head(out)
-    output_dim = out.shape[-1]
+    in_dim = output_dim
+    output_dim = head.output_dim
+    if output_dim is None:
+        output_dim = infer_output_dim(head, torch.zeros((1, 1, in_dim)))
     
     # policy
     policy_cfg['in_dim'] = output_dim
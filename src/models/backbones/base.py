@@ -21,4 +21,7 @@ class BaseBackbone(nn.Module, metaclass=ABCMeta):
     
     @property
     def output_dim(self):
-        pass
\ No newline at end of file
+        """
+        [return] d of the (n, t, d) output, None if it is inferred from a forward pass
+        """
+        return None
\ No newline at end of file
@@ -1,9 +1,17 @@
 import torch.nn as nn
 import torch
+import warnings
 import numpy as np
 from einops import rearrange
 from src.models.backbones.base import BaseBackbone
-from src.common.train_utils import orthogonal_init, init_normalization, renormalize
+from src.common.train_utils import orthogonal_init, init_normalization, renormalize, checkpoint_forward
+
+# failures of torch.compile itself (dynamo tracing / backend compilation), not of the model
+try:
+    from torch._dynamo.exc import TorchDynamoException
+    COMPILE_ERRORS = (TorchDynamoException,)
+except ImportError:
+    COMPILE_ERRORS = ()
 
 
 def fixup_init(layer, num_layers):
@@ -84,7 +92,10 @@ class Impala(BaseBackbone):
                  blocks_per_group,
                  norm_type,
                  init_type,
-                 renormalize):
+                 renormalize,
+                 checkpoint_activations,
+                 channels_last,
+                 compile_forward):
         super().__init__()
         self.obs_shape = obs_shape
         f, c, h, w = obs_shape
@@ -116,11 +127,64 @@ class Impala(BaseBackbone):
         if init_type == 'orthogonal':
             self.apply(orthogonal_init)
         self.renormalize = renormalize
+        self.channels = channels
+        self.strides = strides
+        self.blocks_per_group = blocks_per_group
+        self.expansion_ratio = expansion_ratio
+        self.checkpoint_activations = checkpoint_activations
+        
+        # fast path: NHWC convolutions and a torch.compile'd forward (eager if compilation is unavailable or fails)
+        self.channels_last = channels_last
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+        self.compile_forward = compile_forward and hasattr(torch, 'compile')
+        if compile_forward and not self.compile_forward:
+            warnings.warn('compile_forward requires torch.compile (torch >= 2.0), Impala runs eager')
+        self._compiled_forward = None
+
+    def __getstate__(self):
+        # the compiled function is bound to this instance: copies / pickles re-compile lazily
+        state = self.__dict__.copy()
+        state['_compiled_forward'] = None
+        return state
+
+    @property
+    def output_dim(self):
+        # spatial size is set by the (stride x stride) down-sampling conv of each group
+        f, c, h, w = self.obs_shape
+        for stride in self.strides:
+            h = (h - stride) // stride + 1
+            w = (w - stride) // stride + 1
+        return int(self.channels[-1]) * h * w
+
+    def _run_layers(self, x):
+        return self.layers(x)
+    
+    def _compiled_layers(self, x):
+        if self._compiled_forward is None:
+            self._compiled_forward = torch.compile(self._run_layers)
+        try:
+            return self._compiled_forward(x)
+        except COMPILE_ERRORS as e:
+            warnings.warn('torch.compile failed, Impala falls back to eager: ' + repr(e))
+            self.compile_forward = False
+            return self.layers(x)
 
     def forward(self, x):
         n, t, f, c, h, w = x.shape
         x = rearrange(x, 'n t f c h w -> (n t) (f c) h w')
-        x = self.layers(x)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self.checkpoint_activations and self.training and torch.is_grad_enabled():
+            # checkpoint per residual group, slices share the modules (and state_dict keys) of self.layers
+            for idx in range(0, len(self.layers) - 1, self.blocks_per_group):
+                group = self.layers[idx:idx + self.blocks_per_group]
+                x = checkpoint_forward(group, group, x)
+            x = self.layers[-1](x)
+        elif self.compile_forward:
+            x = self._compiled_layers(x)
+        else:
+            x = self.layers(x)
         if self.renormalize:
             x = renormalize(x)
         x = rearrange(x, '(n t) d -> n t d', t=t)
@@ -29,6 +29,14 @@ class Nature(BaseBackbone):
         if init_type == 'orthogonal':
             self.apply(orthogonal_init)
         self.renormalize = renormalize
+
+    @property
+    def output_dim(self):
+        f, c, h, w = self.obs_shape
+        for kernel_size, stride in [(8, 4), (4, 2), (3, 1)]:
+            h = (h - kernel_size) // stride + 1
+            w = (w - kernel_size) // stride + 1
+        return 64 * h * w
             
     def forward(self, x):
         n, t, f, c, h, w = x.shape
@@ -23,3 +23,16 @@ class Model(nn.Module):
             'policy': p_info
         }
         return x, info
+
+    def forward_from_features(self, x):
+        """
+        [params] x: (n,t,d) backbone features
+        """
+        x, h_info = self.head(x)
+        x, p_info = self.policy(x)
+        info = {
+            'backbone': {},
+            'head': h_info,
+            'policy': p_info
+        }
+        return x, info
@@ -11,3 +11,10 @@ class BaseHead(nn.Module, metaclass=ABCMeta):
     def get_name(cls):
         return cls.name
 
+    @property
+    def output_dim(self):
+        """
+        [return] d of the (n, t, d) output, None if it is inferred from a forward pass
+        """
+        return None
+
@@ -7,6 +7,11 @@ class IdentityHead(BaseHead):
     name = 'identity'
     def __init__(self, in_dim):
         super().__init__()
+        self.in_dim = in_dim
+
+    @property
+    def output_dim(self):
+        return self.in_dim
         
     def forward(self, x):
         info = {}
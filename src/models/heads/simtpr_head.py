@@ -20,7 +20,8 @@ class SimTPRHead(BaseHead):
                  proj_bn,
                  pred_bn,
                  num_layers,
-                 dropout):
+                 dropout,
+                 checkpoint_activations):
         
         super().__init__()
         self.t_step = t_step
@@ -48,7 +49,8 @@ class SimTPRHead(BaseHead):
                                    depth=num_layers, 
                                    heads=proj_dim//64, 
                                    mlp_dim=proj_dim*4, 
-                                   dropout=dropout)
+                                   dropout=dropout,
+                                   checkpoint_activations=checkpoint_activations)
                                     
         self.obs_pred = nn.Sequential(nn.Linear(proj_dim, pred_dim, bias=False), 
                                       nn.BatchNorm1d(pred_dim), 
@@ -75,6 +77,11 @@ class SimTPRHead(BaseHead):
         torch.nn.init.normal_(self.obs_pred[-1].weight, std=.02)
         
         
+    @property
+    def output_dim(self):
+        # forward() passes the backbone features through
+        return self.in_dim
+
     def encode_obs(self, obs):
         n, t, d = obs.shape
         obs = rearrange(obs, 'n t d-> (n t) d')
@@ -89,29 +96,47 @@ class SimTPRHead(BaseHead):
         act = self.act_in(act) + self.pos_embed[:, :t, :]
         
         if dataset_type == 'video':
-            T = t
             x = obs
             
         elif dataset_type == 'demonstration':
-            T = 2*t
-            x = torch.zeros((n, T, d), device=(obs.device))
-            x[:, torch.arange(t) * 2, :] += obs
-            x[:, torch.arange(t) * 2 + 1, :] += act
+            x = interleave(obs, act)
         
         # decode
-        attn_mask = 1 - torch.ones((n, T, T), device=(x.device)).tril_()
-        x, _ = self.decoder(x, attn_mask=attn_mask)
+        x, _ = self.decoder(x, is_causal=True)
         
         if dataset_type == 'video':
             obs = x
             act = torch.zeros_like(x)
             
         elif dataset_type == 'demonstration':
-            obs = x[:, torch.arange(t)*2+1, :] # o_(t+1), ... o_(T+1)
-            act = x[:, torch.arange(t)*2, :]   # a_(t), ... a_(T)
+            act, obs = deinterleave(x, 2) # a_(t), ... a_(T) / o_(t+1), ... o_(T+1)
     
         return obs, act
-    
+
+    def init_kv_cache(self, dataset_type):
+        num_tokens = 1 if dataset_type == 'video' else 2
+        return self.decoder.init_kv_cache(max_len=num_tokens * self.pos_embed.shape[1])
+
+    def decode_step(self, token, token_type, dataset_type, kv_cache):
+        """
+        Incremental decode, equivalent to the matching position of decode() on the full sequence.
+        Tokens are fed in order: o_1, (a_1), o_2, (a_2), ...
+        [params] token: (n, d) encoded observation if token_type == 'obs', (n,) action if 'act'
+        [params] kv_cache: from init_kv_cache(), updated in-place
+        [returns] x: (n, d) decoded feature at the new token
+        """
+        num_tokens = 1 if dataset_type == 'video' else 2
+        t, offset = divmod(kv_cache.length, num_tokens)
+        expected_type = 'obs' if offset == 0 else 'act'
+        if token_type != expected_type:
+            raise ValueError('expected ' + expected_type + ' token at position ' + str(kv_cache.length))
+
+        if token_type == 'act':
+            token = self.act_in(token)
+        x = token + self.pos_embed[:, t, :]
+        x, _ = self.decoder(x.unsqueeze(1), is_causal=True, kv_cache=kv_cache)
+
+        return x.squeeze(1)
 
     def predict(self, obs, act):
         n, t, d = obs.shape
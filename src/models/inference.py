@@ -0,0 +1,175 @@
+import copy
+import warnings
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.fx.proxy import TraceError
+from src.models.policies.rainbow_policy import NoisyLinear, FusedNoisyLinear
+
+
+######################
+# inference-only transforms
+def fold_batch_norm(module):
+    """
+    Folds every Conv2d -> BatchNorm2d pair inside nn.Sequential containers into a single Conv2d (in-place),
+    the batchnorm is replaced by nn.Identity. Requires batchnorm in eval mode.
+    """
+    for child in module.modules():
+        if not isinstance(child, nn.Sequential):
+            continue
+        for idx in range(len(child) - 1):
+            conv, bn = child[idx], child[idx + 1]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                if bn.training:
+                    raise ValueError('batchnorm folding requires the batchnorm in eval mode')
+                child[idx] = fuse_conv_bn_eval(conv, bn)
+                child[idx + 1] = nn.Identity()
+
+    return module
+
+
+def drop_identity(module):
+    """
+    Removes nn.Identity layers from the nn.Sequential containers of the module (in-place).
+    """
+    for child in module.modules():
+        if isinstance(child, nn.Sequential):
+            layers = [layer for layer in child if not isinstance(layer, nn.Identity)]
+            if len(layers) < len(child):
+                for key in list(child._modules.keys()):
+                    del child._modules[key]
+                for idx, layer in enumerate(layers):
+                    child.add_module(str(idx), layer)
+
+    return module
+
+
+def _to_linear(layer):
+    # forward of the layer in its current mode: mu + sigma * (eps_out ⊗ eps_in) if training, mu otherwise
+    weight, bias = layer.weight_mu, layer.bias_mu
+    if layer.training:
+        if isinstance(layer, FusedNoisyLinear):
+            epsilon_in = layer.epsilon_in.repeat_interleave(layer.out_features, 0)
+        else:
+            epsilon_in = layer.epsilon_in.unsqueeze(0)
+        weight = weight + layer.weight_sigma * layer.epsilon_out.unsqueeze(1) * epsilon_in
+        bias = bias + layer.bias_sigma * layer.epsilon_out
+
+    linear = nn.Linear(weight.shape[1], weight.shape[0], device=weight.device, dtype=weight.dtype)
+    linear.weight.copy_(weight)
+    linear.bias.copy_(bias)
+
+    return linear
+
+
+@torch.no_grad()
+def collapse_noisy_linear(module):
+    """
+    Replaces NoisyLinear / FusedNoisyLinear layers by nn.Linear (in-place).
+    Layers in training mode keep their currently sampled noise, layers in eval mode keep the mu weights.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, (NoisyLinear, FusedNoisyLinear)):
+            setattr(module, name, _to_linear(child))
+        else:
+            collapse_noisy_linear(child)
+
+    return module
+
+
+def _simplify(model):
+    fold_batch_norm(model)
+    drop_identity(model)
+    collapse_noisy_linear(model)
+    for param in model.parameters():
+        param.requires_grad = False
+    
+    return model
+
+
+@torch.no_grad()
+def export_inference_model(model):
+    """
+    Inference-only (eval mode) copy of the model with the same greedy forward: 
+    conv -> batchnorm pairs are folded into one conv, nn.Identity layers are removed 
+    and NoisyLinear layers become nn.Linear with the mu weights.
+    The state_dict keys of the copy differ from the model.
+    """
+    export_model = copy.deepcopy(model).eval()
+    
+    return _simplify(export_model)
+
+
+class GreedyActor(nn.Module):
+    """
+    Greedy action of a distributional (rainbow) model from raw observations, entry point of exported actors.
+    Observations are preprocessed as in the replay buffer's encode_obs.
+    """
+    def __init__(self, model, v_min, v_max):
+        super().__init__()
+        self.model = model
+        self.register_buffer('support', torch.linspace(v_min, v_max, model.policy.get_num_atoms()))
+
+    def forward(self, obs):
+        """
+        [params] obs: (n, f, c, h, w) uint8
+        [returns] action: (n,)
+        """
+        x = obs.float().div(255.0).unsqueeze(1)
+        q_dist, _ = self.model(x)
+        q_value = (q_dist * self.support.reshape(1,1,-1)).sum(-1)
+        
+        return torch.argmax(q_value, -1)
+
+
+######################
+# int8 actor
+def _quantize_static(module, calib_inputs):
+    """
+    FX post-training static quantization of a traceable module, calibrated on calib_inputs.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    module = prepare_fx(module, qconfig_mapping, example_inputs=(calib_inputs[:1],))
+    module(calib_inputs)
+
+    return convert_fx(module)
+
+
+@torch.no_grad()
+def quantize_actor(model, calib_obs, quant_type):
+    """
+    INT8 copy of the model for cpu action selection, matching the forward of its current train / eval mode.
+    Batchnorm (eval mode) is folded into the convolutions and NoisyLinear layers become nn.Linear.
+    [params] calib_obs: (n, t, f, c, h, w) observations to calibrate the static activation ranges
+    [params] quant_type: 'static': int8 backbone convolutions (static) and linear layers (dynamic)
+                         'dynamic': int8 linear layers (dynamic), fp32 backbone
+    [returns] actor: Model on cpu, inference only
+    """
+    if quant_type not in ['static', 'dynamic']:
+        raise ValueError('unknown quant_type: ' + str(quant_type))
+
+    actor = copy.deepcopy(model).cpu()
+    for module in actor.backbone.modules():
+        if isinstance(module, nn.modules.batchnorm._BatchNorm) and module.training:
+            raise ValueError('quantize_actor requires the backbone batchnorm in eval mode')
+    _simplify(actor)
+
+    # the convolution stack of the backbone (outside einops reshapes, which fx can not trace)
+    if quant_type == 'static':
+        layers = actor.backbone.layers
+        calib_inputs = []
+        handle = layers.register_forward_pre_hook(lambda module, inputs: calib_inputs.append(inputs[0]))
+        actor.backbone(calib_obs.cpu())
+        handle.remove()
+        try:
+            actor.backbone.layers = _quantize_static(layers, calib_inputs[0])
+        except (TraceError, NotImplementedError, RuntimeError) as e:
+            # fx can not trace the layers, or the quantized engine lacks a kernel: other errors are bugs
+            if isinstance(e, RuntimeError) and 'quantized' not in str(e):
+                raise
+            warnings.warn('static quantization failed, the actor keeps the fp32 backbone: ' + repr(e))
+
+    return torch.ao.quantization.quantize_dynamic(actor, {nn.Linear}, dtype=torch.qint8)
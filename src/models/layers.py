@@ -1,14 +1,81 @@
+import functools
 import torch.nn as nn
+import torch.nn.functional as F
 import torch
 import numpy as np
 from einops import rearrange, repeat
 from einops.layers.torch import Rearrange
-from src.common.train_utils import transformer_init
+from src.common.train_utils import transformer_init, checkpoint_forward
 from src.common.vit_utils import get_1d_sincos_pos_embed_from_grid
 
 
+#################################################
+# Masks & token interleaving
+# cached masks are shared, do not modify in-place
+# used by the kv cache (chunked queries) and the explicit attention path, SDPA is_causal needs no mask:
+# a few (t, device) keys are live per run, the bound keeps varying lengths from growing the cache
+@functools.lru_cache(maxsize=16)
+def get_causal_mask(t, device, dtype=torch.bool):
+    """
+    [returns] mask: (t, t), broadcastable over (n, h, t, t), non-zero where attention is blocked
+    """
+    mask = torch.ones((t, t), device=device, dtype=torch.bool).triu_(1)
+    return mask.to(dtype)
+
+
+def interleave(*tokens):
+    """
+    [params] tokens: k tensors of shape (n, t, d)
+    [returns] x: (n, k*t, d), tokens of each time-step are placed consecutively
+    """
+    n, t, d = tokens[0].shape
+    return torch.stack(tokens, dim=2).reshape(n, len(tokens) * t, d)
+
+
+def deinterleave(x, num_tokens):
+    """
+    [params] x: (n, k*t, d)
+    [returns] tokens: k views of shape (n, t, d), inverse of interleave
+    """
+    n, T, d = x.shape
+    return x.reshape(n, T // num_tokens, num_tokens, d).unbind(dim=2)
+
+
 #################################################
 # Transformer
+class KVCache():
+    def __init__(self, depth, max_len):
+        """
+        Per-layer key / value buffers for incremental decoding.
+        Buffers are allocated on the first update with shape (n, h, max_len, d).
+        """
+        self.max_len = max_len
+        self.length = 0
+        self.keys = [None] * depth
+        self.values = [None] * depth
+
+    def update(self, layer_idx, k, v):
+        """
+        [params] k, v: (n, h, t, d) keys and values of the new tokens
+        [returns] k, v: (n, h, length + t, d) keys and values of the whole prefix
+        """
+        t = k.shape[2]
+        if self.length + t > self.max_len:
+            raise ValueError('kv cache overflow: ' + str(self.length + t) + ' > ' + str(self.max_len))
+        if self.keys[layer_idx] is None:
+            n, h, _, d = k.shape
+            self.keys[layer_idx] = k.new_empty((n, h, self.max_len, d))
+            self.values[layer_idx] = v.new_empty((n, h, self.max_len, d))
+        self.keys[layer_idx][:, :, self.length:self.length + t] = k
+        self.values[layer_idx][:, :, self.length:self.length + t] = v
+        
+        end = self.length + t
+        return self.keys[layer_idx][:, :, :end], self.values[layer_idx][:, :, :end]
+
+    def advance(self, t):
+        self.length += t
+
+
 class PreNorm(nn.Module):
     def __init__(self, dim, fn):
         super().__init__()
@@ -51,26 +118,63 @@ class Attention(nn.Module):
             nn.Dropout(dropout)
         ) 
 
-    def forward(self, x, attn_mask=None):
+    def forward(self, x, attn_mask=None, is_causal=False, return_attn=False, kv_cache=None, layer_idx=0):
+        """
+        [params] x: (n, t, d)
+        [params] attn_mask: (n, t, s) or (t, s), non-zero where attention is blocked
+        [params] is_causal: block attention to future tokens (attn_mask is ignored)
+        [params] return_attn: materialize and return the attention map
+        [params] kv_cache: KVCache holding the keys / values of the s - t previous tokens
+        [returns] out: (n, t, d), attn: (n, h, t, s) or None
+        """
         qkv = self.to_qkv(x).chunk(3, dim = -1)
         q, k, v = map(lambda t: rearrange(t, 'n t (h d) -> n h t d', h = self.heads), qkv)
-
-        dots = torch.matmul(q, k.transpose(-1, -2)) * self.scale
-        if attn_mask is not None:
-            dots.masked_fill_(attn_mask.unsqueeze(1).bool(), -1e9)
         
-        attn = self.attend(dots)
-        attn = self.dropout(attn)
-
-        out = torch.matmul(attn, v)
+        if kv_cache is not None:
+            past = kv_cache.length
+            k, v = kv_cache.update(layer_idx, k, v)
+            # new queries sit at the end of the sequence: causal mask is aligned bottom-right
+            if is_causal and past > 0:
+                is_causal = False
+                attn_mask = None if q.shape[2] == 1 else get_causal_mask(k.shape[2], x.device)[past:]
+        
+        # fused kernel never materializes the (t, t) scores
+        if hasattr(F, 'scaled_dot_product_attention') and not return_attn:
+            if is_causal:
+                attn_mask = None
+            elif attn_mask is not None:
+                attn_mask = ~(attn_mask.bool())
+                if attn_mask.dim() == 3:
+                    attn_mask = attn_mask.unsqueeze(1)
+            dropout_p = self.dropout.p if self.training else 0.0
+            out = F.scaled_dot_product_attention(q, k, v, 
+                                                 attn_mask=attn_mask, 
+                                                 dropout_p=dropout_p, 
+                                                 is_causal=is_causal)
+            attn = None
+            
+        else:
+            dots = torch.matmul(q, k.transpose(-1, -2)) * self.scale
+            if is_causal:
+                attn_mask = get_causal_mask(q.shape[2], x.device)
+            if attn_mask is not None:
+                if attn_mask.dim() == 3:
+                    attn_mask = attn_mask.unsqueeze(1)
+                dots.masked_fill_(attn_mask.bool(), -1e9)
+            
+            attn = self.attend(dots)
+            attn = self.dropout(attn)
+            out = torch.matmul(attn, v)
+            
         out = rearrange(out, 'n h t d -> n t (h d)')
         out = self.to_out(out)
         return out, attn
 
 
 class Transformer(nn.Module):
-    def __init__(self, dim, depth, heads, mlp_dim, dropout = 0.):
+    def __init__(self, dim, depth, heads, mlp_dim, dropout = 0., checkpoint_activations = False):
         super().__init__()
+        self.checkpoint_activations = checkpoint_activations
         self.layers = nn.ModuleList([])
         for _ in range(depth):
             self.layers.append(nn.ModuleList([
@@ -79,13 +183,42 @@ class Transformer(nn.Module):
             ]))
         self.apply(transformer_init)
 
-    def forward(self, x, attn_mask=None):
+    def _layer_forward(self, layer, x, attn_mask, is_causal, return_attn, kv_cache, layer_idx):
+        attn, ff = layer
+        attn_x, attn_map = attn(x, 
+                                attn_mask=attn_mask, 
+                                is_causal=is_causal, 
+                                return_attn=return_attn,
+                                kv_cache=kv_cache,
+                                layer_idx=layer_idx)
+        x = attn_x + x
+        x = ff(x) + x
+        return x, attn_map
+
+    def init_kv_cache(self, max_len):
+        return KVCache(depth=len(self.layers), max_len=max_len)
+
+    def forward(self, x, attn_mask=None, is_causal=False, return_attn_maps=False, kv_cache=None):
+        """
+        [params] kv_cache: if given, x are the new tokens appended after the cached prefix
+        [returns] x: (n, t, d), attn_maps: per-layer attention maps if return_attn_maps else []
+        """
+        # cached keys / values must not be re-written by a recompute
+        checkpoint = (self.checkpoint_activations and self.training 
+                      and torch.is_grad_enabled() and kv_cache is None)
         attn_maps = []
-        for attn, ff in self.layers:
-            attn_x, attn_map = attn(x, attn_mask=attn_mask)
-            x = attn_x + x
-            x = ff(x) + x
-            attn_maps.append(attn_map)
+        for layer_idx, layer in enumerate(self.layers):
+            if checkpoint:
+                x, attn_map = checkpoint_forward(layer, self._layer_forward, layer, x, attn_mask, 
+                                                 is_causal, return_attn_maps, kv_cache, layer_idx)
+            else:
+                x, attn_map = self._layer_forward(layer, x, attn_mask, 
+                                                  is_causal, return_attn_maps, kv_cache, layer_idx)
+            if return_attn_maps:
+                attn_maps.append(attn_map)
+        
+        if kv_cache is not None:
+            kv_cache.advance(x.shape[1])
             
         return x, attn_maps
     
@@ -169,7 +302,7 @@ class TransDet(nn.Module):
         self.apply(xavier_uniform_init)
 
     def forward(self, obs, act=None, rew=None, rtg=None, 
-                      attn_mask=None, dataset_type='demonstration'):
+                      attn_mask=None, is_causal=False, dataset_type='demonstration'):
         """
         [params] obs: (n, t, d)
         [params] act: (n, t)
@@ -189,9 +322,7 @@ class TransDet(nn.Module):
             
             obs = obs + self.pos_embed[:, :t, :]
             act = act + self.pos_embed[:, :t, :]
-            x = torch.zeros((n, 2 * t, d), device=(obs.device))
-            x[:, torch.arange(t) * 2, :] += obs
-            x[:, torch.arange(t) * 2 + 1, :] += act
+            x = interleave(obs, act)
             
         elif dataset_type == 'trajectory':
             if act is None:
@@ -208,13 +339,9 @@ class TransDet(nn.Module):
             rew = rew + self.pos_embed[:, :t, :]
             rtg = rtg + self.pos_embed[:, :t, :]
             
-            x = torch.zeros((n, 4 * t, d), device=(obs.device))
-            x[:, torch.arange(t) * 4, :] += obs
-            x[:, torch.arange(t) * 4 + 1, :] += act
-            x[:, torch.arange(t) * 4 + 2, :] += rew
-            x[:, torch.arange(t) * 4 + 3, :] += rtg
+            x = interleave(obs, act, rew, rtg)
         
-        x, _ = self.decoder(x, attn_mask=attn_mask)
+        x, _ = self.decoder(x, attn_mask=attn_mask, is_causal=is_causal)
         x = self.norm_out(x)
         
         return x
@@ -237,7 +364,7 @@ class TransRtgDet(nn.Module):
         self.pos_embed.copy_(torch.from_numpy(pos_embed).float().unsqueeze(0))
         self.apply(xavier_uniform_init)
 
-    def forward(self, rtg, obs, act, attn_mask=None):
+    def forward(self, rtg, obs, act, attn_mask=None, is_causal=False):
         """
         [params] rtg: (n, t)
         [params] obs: (n, t, d)
@@ -250,12 +377,9 @@ class TransRtgDet(nn.Module):
         obs = obs + self.pos_embed[:, :t, :]
         act = act + self.pos_embed[:, :t, :]
         
-        x = torch.zeros((n, 3 * t, d), device=(obs.device))
-        x[:, torch.arange(t) * 3, :] += rtg
-        x[:, torch.arange(t) * 3 + 1, :] += obs
-        x[:, torch.arange(t) * 3 + 2, :] += act
+        x = interleave(rtg, obs, act)
         
-        x, _ = self.decoder(x, attn_mask=attn_mask)
+        x, _ = self.decoder(x, attn_mask=attn_mask, is_causal=is_causal)
         x = self.norm_out(x)
         
         return x
@@ -7,6 +7,7 @@ from src.common.train_utils import ScaleGrad
 
 
 # Factorised NoisyLinear layer with bias
+# only the factors eps_in, eps_out of the weight noise eps_out ⊗ eps_in are stored
 class NoisyLinear(nn.Module):
     def __init__(self, in_features, out_features, std_init=0.5):
         super(NoisyLinear, self).__init__()
@@ -15,10 +16,10 @@ class NoisyLinear(nn.Module):
         self.std_init = std_init        
         self.weight_mu = nn.Parameter(torch.empty(out_features, in_features))
         self.weight_sigma = nn.Parameter(torch.empty(out_features, in_features))
-        self.register_buffer('weight_epsilon', torch.empty(out_features, in_features))
+        self.register_buffer('epsilon_in', torch.empty(in_features))
         self.bias_mu = nn.Parameter(torch.empty(out_features))
         self.bias_sigma = nn.Parameter(torch.empty(out_features))
-        self.register_buffer('bias_epsilon', torch.empty(out_features))
+        self.register_buffer('epsilon_out', torch.empty(out_features))
         self.reset_parameters()
         self.reset_noise()
 
@@ -34,16 +35,79 @@ class NoisyLinear(nn.Module):
         return x.sign().mul_(x.abs().sqrt_())
 
     def reset_noise(self):
-        epsilon_in = self._scale_noise(self.in_features)
-        epsilon_out = self._scale_noise(self.out_features)
-        self.weight_epsilon.copy_(epsilon_out.ger(epsilon_in))
-        self.bias_epsilon.copy_(epsilon_out)
+        self.epsilon_in.copy_(self._scale_noise(self.in_features))
+        self.epsilon_out.copy_(self._scale_noise(self.out_features))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the factorised buffers: noise is resampled every step anyway
+        state_dict.pop(prefix + 'weight_epsilon', None)
+        if prefix + 'bias_epsilon' in state_dict:
+            state_dict[prefix + 'epsilon_out'] = state_dict.pop(prefix + 'bias_epsilon')
+            state_dict.setdefault(prefix + 'epsilon_in', self.epsilon_in)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, input):
         if self.training:
+            # x (mu + sigma * (eps_out ⊗ eps_in))^T = x mu^T + ((x * eps_in) sigma^T) * eps_out
+            out = F.linear(input, 
+                           self.weight_mu, 
+                           self.bias_mu + self.bias_sigma * self.epsilon_out)
+            return out + F.linear(input * self.epsilon_in, self.weight_sigma) * self.epsilon_out
+        else:
             return F.linear(input, 
-                            self.weight_mu + self.weight_sigma * self.weight_epsilon, 
-                            self.bias_mu + self.bias_sigma * self.bias_epsilon)
+                            self.weight_mu, 
+                            self.bias_mu)
+
+
+# NoisyLinear layers of several branches applied to the same input,
+# computed with one GEMM for mu and one batched GEMM for the noise
+class FusedNoisyLinear(nn.Module):
+    def __init__(self, in_features, out_features, num_branches, std_init=0.5):
+        super(FusedNoisyLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.num_branches = num_branches
+        self.std_init = std_init
+        self.weight_mu = nn.Parameter(torch.empty(num_branches * out_features, in_features))
+        self.weight_sigma = nn.Parameter(torch.empty(num_branches * out_features, in_features))
+        self.register_buffer('epsilon_in', torch.empty(num_branches, in_features))
+        self.bias_mu = nn.Parameter(torch.empty(num_branches * out_features))
+        self.bias_sigma = nn.Parameter(torch.empty(num_branches * out_features))
+        self.register_buffer('epsilon_out', torch.empty(num_branches * out_features))
+        self.reset_parameters()
+        self.reset_noise()
+
+    def reset_parameters(self):
+        mu_range = 1 / math.sqrt(self.in_features)
+        self.weight_mu.data.uniform_(-mu_range, mu_range)
+        self.weight_sigma.data.fill_(self.std_init / math.sqrt(self.in_features))
+        self.bias_mu.data.uniform_(-mu_range, mu_range)
+        self.bias_sigma.data.fill_(self.std_init / math.sqrt(self.out_features))
+
+    def _scale_noise(self, size):
+        x = torch.randn(size, device=self.weight_mu.device)
+        return x.sign().mul_(x.abs().sqrt_())
+
+    def reset_noise(self):
+        # independent noise per branch, as with separate NoisyLinear layers
+        self.epsilon_in.copy_(self._scale_noise((self.num_branches, self.in_features)))
+        self.epsilon_out.copy_(self._scale_noise(self.num_branches * self.out_features))
+
+    def forward(self, input):
+        """
+        [params] input: (..., in_features)
+        [returns] out: (..., num_branches * out_features), branch-major
+        """
+        if self.training:
+            out = F.linear(input, 
+                           self.weight_mu, 
+                           self.bias_mu + self.bias_sigma * self.epsilon_out)
+            # (k, n, in) @ (k, in, out) -> (n, k * out), over the flattened leading dims
+            x = input.reshape(-1, self.in_features)
+            noise = torch.bmm(x.unsqueeze(0) * self.epsilon_in.unsqueeze(1),
+                              self.weight_sigma.view(self.num_branches, self.out_features, -1).transpose(1, 2))
+            noise = noise.transpose(0, 1).reshape(input.shape[:-1] + (-1,))
+            return out + noise * self.epsilon_out
         else:
             return F.linear(input, 
                             self.weight_mu, 
@@ -61,54 +125,64 @@ class RainbowPolicy(BasePolicy):
         super().__init__()
         self.action_size = action_size
         self.num_atoms = num_atoms
-        self.fc_v = nn.Sequential(
-            NoisyLinear(in_dim, hid_dim, noisy_std),
-            nn.ReLU(),
-            NoisyLinear(hid_dim, num_atoms, noisy_std)
-        )
-        self.fc_adv = nn.Sequential(
-            NoisyLinear(in_dim, hid_dim, noisy_std),
-            nn.ReLU(),
-            NoisyLinear(hid_dim, action_size * num_atoms, noisy_std)
-        )
+        # first layers of the value and advantage streams are fused
+        self.fc_hid = FusedNoisyLinear(in_dim, hid_dim, 2, noisy_std)
+        self.fc_v = NoisyLinear(hid_dim, num_atoms, noisy_std)
+        self.fc_adv = NoisyLinear(hid_dim, action_size * num_atoms, noisy_std)
         self.grad_scale = 2 ** (-1 / 2)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints with separate fc_v / fc_adv streams (nn.Sequential of 2 NoisyLinear)
+        if prefix + 'fc_v.0.weight_mu' in state_dict:
+            for name in ['weight_mu', 'weight_sigma', 'bias_mu', 'bias_sigma']:
+                state_dict[prefix + 'fc_hid.' + name] = torch.cat([state_dict.pop(prefix + 'fc_v.0.' + name), 
+                                                                   state_dict.pop(prefix + 'fc_adv.0.' + name)])
+            for key in list(state_dict.keys()):
+                for branch in ['fc_v', 'fc_adv']:
+                    if key.startswith(prefix + branch + '.0.'):
+                        state_dict.pop(key)
+                    elif key.startswith(prefix + branch + '.2.'):
+                        name = key[len(prefix + branch + '.2.'):]
+                        state_dict[prefix + branch + '.' + name] = state_dict.pop(key)
+            state_dict[prefix + 'fc_hid.epsilon_in'] = self.fc_hid.epsilon_in
+            state_dict[prefix + 'fc_hid.epsilon_out'] = self.fc_hid.epsilon_out
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x, log=False):
-        scale_grad = getattr(ScaleGrad, "apply", None)
-        x = scale_grad(x, self.grad_scale)
-        v = self.fc_v(x)
-        adv = self.fc_adv(x)
+        # the gradient scale only acts on backward, 
+        # skipping it without grad keeps the python autograd function out of traced / exported graphs
+        if torch.is_grad_enabled():
+            scale_grad = getattr(ScaleGrad, "apply", None)
+            x = scale_grad(x, self.grad_scale)
+        h_v, h_adv = F.relu(self.fc_hid(x)).chunk(2, -1)
+        v = self.fc_v(h_v)
+        adv = self.fc_adv(h_adv)
 
-        v = v.view(-1, 1, self.num_atoms)
-        adv = adv.view(-1, self.action_size, self.num_atoms)
+        # distributions are computed in fp32 under autocast
+        v = v.float().view(-1, 1, self.num_atoms)
+        adv = adv.float().view(-1, self.action_size, self.num_atoms)
         
-        # numerical stability for dueling
-        q = v + adv - adv.mean(1, keepdim=True)
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            # numerical stability for dueling
+            q = v + adv - adv.mean(1, keepdim=True)
 
-        # (batch_size, action_size, num_atoms)
-        log_q = F.log_softmax(q, -1)
-        q = torch.exp(log_q)
+            # (batch_size, action_size, num_atoms)
+            log_q = F.log_softmax(q, -1)
+            q = torch.exp(log_q)
         
         info = {'log': log_q}
         
         return q, info
 
     def reset_noise(self):
-        for name, branch in self.named_children():
-            modules = [m for m in branch.children()]
-            for module in modules:
-                module_name = module.__class__.__name__
-                if module_name == 'NoisyLinear':
-                    module.reset_noise()
+        for module in self.modules():
+            if isinstance(module, (NoisyLinear, FusedNoisyLinear)):
+                module.reset_noise()
                     
     def reset_parameter(self):
-        for name, branch in self.named_children():
-            modules = [m for m in branch.children()]
-            for module in modules:
-                module_name = module.__class__.__name__
-                if module_name == 'NoisyLinear':
-                    module.reset_parameters()
+        for module in self.modules():
+            if isinstance(module, (NoisyLinear, FusedNoisyLinear)):
+                module.reset_parameters()
 
     def get_num_atoms(self):
-        return self.num_atoms
\ No newline at end of file
+        return self.num_atoms
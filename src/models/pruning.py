@@ -0,0 +1,164 @@
+import torch
+from src.models.backbones.cnn.impala import Impala, ResidualBlock
+
+
+# ResidualBlock.layers with expansion_ratio > 1:
+# conv1 (1x1) -> norm1 -> relu -> conv2 (3x3 depthwise) -> norm2 -> relu -> conv3 (1x1) -> norm3
+CONV1, NORM1, CONV2, NORM2, CONV3, NORM3 = 0, 1, 3, 4, 6, 7
+
+
+def _groups(backbone):
+    """
+    [returns] list of residual groups, each a list of (block index, ResidualBlock)
+    """
+    blocks = [(idx, block) for idx, block in enumerate(backbone.layers) if isinstance(block, ResidualBlock)]
+    bpg = backbone.blocks_per_group
+
+    return [blocks[idx:idx + bpg] for idx in range(0, len(blocks), bpg)]
+
+
+def _check_prunable(backbone):
+    if not isinstance(backbone, Impala):
+        raise ValueError('channel pruning is only supported for the impala backbone')
+    if backbone.expansion_ratio == 1:
+        raise ValueError('channel pruning requires expansion_ratio > 1')
+
+
+######################
+# channel importance
+def bn_channel_scores(backbone):
+    """
+    Channel importance from the |scale| of the normalization layers.
+    [returns] stream_scores: per group (channels,): summed |norm3 scale| of the group's residual branches
+              hidden_scores: per block (hid_channels,): |norm2 scale| after the depthwise conv
+    """
+    _check_prunable(backbone)
+    stream_scores, hidden_scores = [], []
+    for group in _groups(backbone):
+        if getattr(group[0][1].layers[NORM3], 'weight', None) is None:
+            raise ValueError('bn channel scores require affine normalization layers (norm_type: bn)')
+        stream_scores.append(sum(block.layers[NORM3].weight.detach().abs() for _, block in group))
+        hidden_scores += [block.layers[NORM2].weight.detach().abs() for _, block in group]
+
+    return stream_scores, hidden_scores
+
+
+@torch.no_grad()
+def activation_channel_scores(backbone, obs_loader):
+    """
+    Channel importance from the mean |activation| on observations.
+    [params] obs_loader: iterable of (n, t, f, c, h, w) observations
+    [returns] stream_scores: per group (channels,): summed over the outputs of the group's blocks
+              hidden_scores: per block (hid_channels,): input of conv3 (after the depthwise conv and relu)
+    """
+    _check_prunable(backbone)
+    groups = _groups(backbone)
+    stream_sums = [0.0 for _ in groups]
+    hidden_sums = [0.0 for group in groups for _ in group]
+
+    def stream_hook(group_idx):
+        def hook(module, inputs, output):
+            stream_sums[group_idx] = stream_sums[group_idx] + output.abs().mean((0, 2, 3))
+        return hook
+
+    def hidden_hook(block_idx):
+        def hook(module, inputs):
+            hidden_sums[block_idx] = hidden_sums[block_idx] + inputs[0].abs().mean((0, 2, 3))
+        return hook
+
+    handles = []
+    block_idx = 0
+    for group_idx, group in enumerate(groups):
+        for _, block in group:
+            handles.append(block.register_forward_hook(stream_hook(group_idx)))
+            handles.append(block.layers[CONV3].register_forward_pre_hook(hidden_hook(block_idx)))
+            block_idx += 1
+
+    training = backbone.training
+    backbone.eval()
+    for obs in obs_loader:
+        backbone(obs)
+    backbone.train(training)
+    for handle in handles:
+        handle.remove()
+
+    return stream_sums, hidden_sums
+
+
+######################
+# pruning
+def _take(state_dict, key, idx, dim=0):
+    if key in state_dict:
+        state_dict[key] = state_dict[key].index_select(dim, idx.to(state_dict[key].device))
+
+
+def _take_norm(state_dict, prefix, idx):
+    for name in ['weight', 'bias', 'running_mean', 'running_var']:
+        _take(state_dict, prefix + name, idx)
+
+
+def _topk(scores, k):
+    return torch.topk(scores, k).indices.sort().values
+
+
+@torch.no_grad()
+def prune_impala(model, stream_scores, hidden_scores, keep_ratio):
+    """
+    Structured channel pruning of the impala backbone of a Model.
+    The residual stream of each group with a down conv keeps round(keep_ratio * channels) channels by stream_scores,
+    a group without one keeps the channels of the previous group,
+    each block keeps in_channels * expansion_ratio hidden channels by hidden_scores,
+    and the input features of the first policy layer follow the kept channels of the last group.
+    [returns] state_dict: pruned state_dict of the model
+              channels: tuple of the pruned stream channels, for the backbone config (with scale_ratio: 1)
+    """
+    backbone = model.backbone
+    _check_prunable(backbone)
+    if model.head.output_dim != backbone.output_dim or len(list(model.head.parameters())) > 0:
+        raise ValueError('channel pruning requires a parameter-free pass-through head')
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+
+    in_idx = torch.arange(backbone.in_channel)
+    block_idx = 0
+    channels = []
+    for group, scores in zip(_groups(backbone), stream_scores):
+        # without a down conv the identity path carries the stream of the previous group as is,
+        # so the group keeps the same channels (its own stream_scores are not used)
+        if hasattr(group[0][1], 'down'):
+            out_idx = _topk(scores, max(1, int(round(keep_ratio * len(scores)))))
+        else:
+            out_idx = in_idx
+        channels.append(len(out_idx))
+
+        for idx, block in group:
+            prefix = 'backbone.layers.' + str(idx) + '.'
+            hid_idx = _topk(hidden_scores[block_idx], len(in_idx) * backbone.expansion_ratio)
+            if hasattr(block, 'down'):
+                _take(state_dict, prefix + 'down.weight', out_idx)
+                _take(state_dict, prefix + 'down.weight', in_idx, dim=1)
+                _take(state_dict, prefix + 'down.bias', out_idx)
+
+            layers = prefix + 'layers.'
+            _take(state_dict, layers + str(CONV1) + '.weight', hid_idx)
+            _take(state_dict, layers + str(CONV1) + '.weight', in_idx, dim=1)
+            _take(state_dict, layers + str(CONV1) + '.bias', hid_idx)
+            _take_norm(state_dict, layers + str(NORM1) + '.', hid_idx)
+            _take(state_dict, layers + str(CONV2) + '.weight', hid_idx)
+            _take(state_dict, layers + str(CONV2) + '.bias', hid_idx)
+            _take_norm(state_dict, layers + str(NORM2) + '.', hid_idx)
+            _take(state_dict, layers + str(CONV3) + '.weight', out_idx)
+            _take(state_dict, layers + str(CONV3) + '.weight', hid_idx, dim=1)
+            _take(state_dict, layers + str(CONV3) + '.bias', out_idx)
+            _take_norm(state_dict, layers + str(NORM3) + '.', out_idx)
+
+            in_idx = out_idx
+            block_idx += 1
+
+    # flattened (c h w) features of the kept channels
+    num_pixels = backbone.output_dim // int(backbone.channels[-1])
+    feature_idx = (in_idx.unsqueeze(1) * num_pixels + torch.arange(num_pixels)).flatten()
+    for name in ['weight_mu', 'weight_sigma', 'epsilon_in']:
+        key = 'policy.fc_hid.' + name
+        _take(state_dict, key, feature_idx, dim=state_dict[key].dim() - 1)
+
+    return state_dict, tuple(channels)
@@ -7,8 +7,9 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import Dataset, DataLoader
-from src.common.train_utils import CosineAnnealingWarmupRestarts, get_grad_norm_stats
+from src.common.train_utils import CosineAnnealingWarmupRestarts, get_grad_norm_stats, autocast
 from src.common.losses import SoftmaxFocalLoss
+from src.models.inference import export_inference_model
 from sklearn.metrics import f1_score
 from einops import rearrange
 
@@ -78,7 +79,8 @@ class BaseTrainer():
             rew = batch.reward.to(self.device)
             done = batch.done.to(self.device)
             rtg = batch.rtg.to(self.device)
-            loss, train_logs = self.compute_loss(obs, act, rew, done, rtg,'train')
+            with autocast(self.device, self.cfg.autocast):
+                loss, train_logs = self.compute_loss(obs, act, rew, done, rtg,'train')
 
             # backward
             self.optimizer.zero_grad()
@@ -95,6 +97,28 @@ class BaseTrainer():
         self.logger.update_log(**eval_logs)
         self.logger.write_log(step=0)
     
+    def train_step(self, batch) -> dict:
+        # forward
+        self.model.train()
+        obs = batch.observation.to(self.device)
+        act = batch.action.to(self.device)
+        rew = batch.reward.to(self.device)
+        done = batch.done.to(self.device)
+        rtg = batch.rtg.to(self.device)
+        with autocast(self.device, self.cfg.autocast):
+            loss, train_logs = self.compute_loss(obs, act, rew, done, rtg, 'train')
+        
+        # backward
+        self.optimizer.zero_grad()
+        loss.backward()
+        grad_stats = get_grad_norm_stats(self.model)
+        train_logs.update(grad_stats)
+        torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.cfg.clip_grad_norm)
+        self.optimizer.step()
+        self.update(obs, act, rew, done, rtg)
+        
+        return train_logs
+    
     def train(self):
         step = 0
         
@@ -110,23 +134,7 @@ class BaseTrainer():
         # train
         for e in range(1, self.cfg.num_epochs+1):
             for batch in tqdm.tqdm(self.train_loader):   
-                # forward
-                self.model.train()
-                obs = batch.observation.to(self.device)
-                act = batch.action.to(self.device)
-                rew = batch.reward.to(self.device)
-                done = batch.done.to(self.device)
-                rtg = batch.rtg.to(self.device)
-                loss, train_logs = self.compute_loss(obs, act, rew, done, rtg, 'train')
-                
-                # backward
-                self.optimizer.zero_grad()
-                loss.backward()
-                grad_stats = get_grad_norm_stats(self.model)
-                train_logs.update(grad_stats)
-                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.cfg.clip_grad_norm)
-                self.optimizer.step()
-                self.update(obs, act, rew, done, rtg)
+                train_logs = self.train_step(batch)
                     
                 # log         
                 self.logger.update_log(**train_logs)
@@ -172,6 +180,8 @@ class BaseTrainer():
     
     def evaluate_policy(self):
         self.model.eval()
+        # batchnorm folded, greedy copy of the model for the rollouts
+        model = export_inference_model(self.model)
         for _ in tqdm.tqdm(range(self.cfg.num_eval_trajectories)):
             obs = self.env.reset()
             while True:
@@ -185,7 +195,7 @@ class BaseTrainer():
                 
                 # eps-greedy
                 with torch.no_grad():
-                    logits, _ = self.model(obs)
+                    logits, _ = model(obs)
                 argmax_action = torch.argmax(logits, -1)[0].item()
                 eps = self.cfg.eval_eps
                 prob = random.random()
@@ -32,13 +32,16 @@ class SimTPRTrainer(BaseTrainer):
     def compute_loss(self, obs, act, rew, done, rtg, mode):
         ####################
         # augmentation
-        n, t, f, c, h, w = obs.shape
-        x = obs / 255.0
-        x = rearrange(x, 'n t f c h w -> n (t f c) h w')
-        x1, x2 = self.aug_func(x), self.aug_func(x)
-        x = torch.cat([x1, x2], axis=0)        
-        x = rearrange(x, 'n (t f c) h w -> n t f c h w', t=t, f=f)
-        act = torch.cat([act, act], axis=0)
+        # float observations are views already augmented by the loader workers (worker_aug),
+        # the loader enforces num_views == 2 to match the two views paired below
+        if obs.dtype == torch.uint8:
+            n, t, f, c, h, w = obs.shape
+            x = rearrange(obs, 'n t f c h w -> n (t f c) h w')
+            x = self.aug_func(x, num_views=2)
+            x = rearrange(x, 'n (t f c) h w -> n t f c h w', t=t, f=f)
+        else:
+            x = obs
+        act = act.repeat(2, 1)
         
         #################
         # forward